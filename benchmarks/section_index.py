@@ -0,0 +1,142 @@
+'''
+Benchmark SectionIndex against the linear module/section scan that
+resolve_mem_map() used before it.
+
+The layout is synthetic: 500 modules x 20 sections, built from plain Python
+objects that answer the SB calls the scan makes. Every module also carries
+a __PAGEZERO at address 0 and they all share one __LINKEDIT range, like
+images of the dyld shared cache, so overlapping sections are exercised too.
+
+utils imports lldb, run it with lldb's Python path:
+
+	PYTHONPATH=$(lldb -P) python3 benchmarks/section_index.py
+'''
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils import build_section_index
+
+NUM_MODULES = 500
+NUM_SECTIONS = 20
+NUM_LOOKUPS = 2000
+SECTION_SIZE = 0x4000
+MODULE_BASE = 0x100000000
+MODULE_STRIDE = 0x200000
+LINKEDIT_BASE = 0x7fff80000000
+LINKEDIT_SIZE = 0x100000
+PAGEZERO_SIZE = 0x100000000
+
+class FakeFile(object):
+	def __init__(self, basename):
+		self.basename = basename
+
+class FakeSection(object):
+	def __init__(self, name, start, size, perms):
+		self.name = name
+		self.start = start
+		self.size = size
+		self.perms = perms
+
+	def GetLoadAddress(self, target):
+		return self.start
+
+	def GetFileByteSize(self):
+		return self.size
+
+	def GetName(self):
+		return self.name
+
+	def GetPermissions(self):
+		return self.perms
+
+class FakeModule(object):
+	def __init__(self, basename, sections):
+		self.file = FakeFile(basename)
+		self.sections = sections
+
+class FakeTarget(object):
+	def __init__(self, modules):
+		self.modules = modules
+
+def build_target():
+	modules = []
+	for m in range(NUM_MODULES):
+		base = MODULE_BASE + m * MODULE_STRIDE
+		sections = [FakeSection('__PAGEZERO', 0, PAGEZERO_SIZE, 0)]
+		for s in range(NUM_SECTIONS - 2):
+			sections.append(FakeSection('__s%d' % s, base + s * SECTION_SIZE, SECTION_SIZE, 5))
+		# unloaded sections are skipped by both lookups
+		sections.append(FakeSection('__unloaded', 0xffffffffffffffff, SECTION_SIZE, 0))
+		sections.append(FakeSection('__LINKEDIT', LINKEDIT_BASE, LINKEDIT_SIZE, 1))
+		modules.append(FakeModule('lib%d.dylib' % m, sections))
+	return FakeTarget(modules)
+
+def linear_lookup(target, addr):
+	# resolve_mem_map() before SectionIndex, first match in module order
+	for module in target.modules:
+		absolute_offset = 0
+		for section in module.sections:
+			if section.GetLoadAddress(target) == 0xffffffffffffffff:
+				continue
+
+			start_addr = section.GetLoadAddress(target)
+			end_addr = start_addr + section.GetFileByteSize()
+			if start_addr <= addr <= end_addr:
+				offset = addr - start_addr
+				return (module.file.basename, section.GetName(), section.GetPermissions(),
+						offset, absolute_offset + offset)
+
+			absolute_offset += section.GetFileByteSize()
+
+	return None
+
+def index_lookup(index, addr):
+	section = index.lookup(addr)
+	if not section:
+		return None
+	start_addr, end_addr, module_name, section_name, perms, abs_base = section
+	offset = addr - start_addr
+	return (module_name, section_name, perms, offset, abs_base + offset)
+
+def main():
+	rng = random.Random(0)
+	target = build_target()
+
+	last = MODULE_BASE + NUM_MODULES * MODULE_STRIDE
+	addrs = [rng.randrange(MODULE_BASE, last) for i in range(NUM_LOOKUPS)]
+	# overlapping ranges and their edges
+	addrs += [0, PAGEZERO_SIZE - 1, LINKEDIT_BASE, LINKEDIT_BASE + 0x1234,
+			LINKEDIT_BASE + LINKEDIT_SIZE, LINKEDIT_BASE + LINKEDIT_SIZE + 1, last + 0x1000]
+
+	start = time.perf_counter()
+	expected = [linear_lookup(target, addr) for addr in addrs]
+	linear_time = time.perf_counter() - start
+
+	start = time.perf_counter()
+	index = build_section_index(target)
+	build_time = time.perf_counter() - start
+
+	start = time.perf_counter()
+	results = [index_lookup(index, addr) for addr in addrs]
+	index_time = time.perf_counter() - start
+
+	mismatches = [(hex(a), e, r) for a, e, r in zip(addrs, expected, results) if e != r]
+	for mismatch in mismatches[:10]:
+		print('[-] mismatch at %s: linear %s, index %s' % mismatch)
+
+	print('sections    : %d indexed' % len(index))
+	print('lookups     : %d' % len(addrs))
+	print('linear scan : %.1f us/lookup' % (linear_time / len(addrs) * 1e6))
+	print('index build : %.1f ms (once)' % (build_time * 1e3))
+	print('bisect index: %.1f us/lookup' % (index_time / len(addrs) * 1e6))
+	if mismatches:
+		print('[-] %d results differ from the linear scan' % len(mismatches))
+		return 1
+	print('[+] results identical to the linear scan')
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
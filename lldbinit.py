@@ -83,10 +83,14 @@ import  struct
 import  argparse
 import  subprocess
 import  tempfile
+import  threading
+import  zlib
+from bisect import bisect_right
 from struct import *
 
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
 from utils import *
+from pattern import *
 from xnu import *
 
 try:
@@ -110,6 +114,9 @@ CONFIG_DISPLAY_FLOW_WINDOW = 0
 CONFIG_NO_CTX = 0
 CONFIG_ENABLE_REGISTER_SHORTCUTS = 1
 CONFIG_DISPLAY_DATA_WINDOW = 0
+# render the context on a background thread, stops arriving faster than it
+# can be drawn (held step key, scripted stepping) only print the latest one
+CONFIG_ASYNC_CONTEXT = 0
 
 # setup the logging level, which is a bitmask of any of the following possible values (don't use spaces, doesn't seem to work)
 #
@@ -142,6 +149,8 @@ old_register = {}
 arm_type = "thumbv7-apple-ios"
 
 GlobalListOutput = []
+# per thread buffer of the context render in progress, see output()
+render_output = threading.local()
 
 Int3Dictionary = {}
 
@@ -157,32 +166,6 @@ flag_regs = ('rflags', 'eflags', 'cpsr')
 
 segment_regs = ("cs", "ds", "es", "gs", "fs", "ss", "cs", "gs", "fs")
 
-x86_registers = [
-    "eax", "ebx", "ebp", "esp", "eflags", "edi", "esi", "edx", "ecx", "eip"
-    "cs", "ds", "es", "gs", "fs", "ss"
-]
-
-x86_64_registers = [
-    "rax", "rbx", "rbp", "rsp", "rflags", "rdi", "rsi", "rdx", "rcx", "rip",
-    "r8", "r9", "r10", "r11", "r12", "r13", "r14", "r15", "cs", "gs", "fs"
-]
-
-arm_32_registers = [
-    "r0", "r1", "r2", "r3", "cpsr", "r4", "r5", "r6", "r7", "r8",
-    "r9", "r10", "r11", "r12", "sp", "lr", "pc"
-]
-
-aarch64_registers = [
-    'x0', 'x1', 'x2', 'x3', 'cpsr',
-    'x4', 'x5', 'x6', 'x7', 
-    'x8', 'x9', 'x10', 'x11',
-    'x12', 'x13', 'x14', 'x15', 
-    'x16', 'x17', 'x18', 'x19', 
-    'x20', 'x21', 'x22', 'x23', 
-    'x24', 'x25', 'x26', 'x27', 
-    'x28', 'x29', 'x30', 'sp', 'pc', 'fpcr', 'fpsr'
-]
-
 XNU_ZONES = None
 SelectedVM = ''
 
@@ -222,8 +205,8 @@ def __lldb_init_module(debugger, internal_dict):
 
     # the hook that makes everything possible :-)
     ci.HandleCommand("command script add -f lldbinit.HandleHookStopOnTarget HandleHookStopOnTarget", res)
-    ci.HandleCommand("command script add -f lldbinit.HandleHookStopOnTarget ctx", res)
-    ci.HandleCommand("command script add -f lldbinit.HandleHookStopOnTarget context", res)
+    ci.HandleCommand("command script add -f lldbinit.cmd_context ctx", res)
+    ci.HandleCommand("command script add -f lldbinit.cmd_context context", res)
     # commands
     ci.HandleCommand("command script add -f lldbinit.cmd_lldbinitcmds lldbinitcmds", res)
     ci.HandleCommand("command script add -f lldbinit.cmd_IphoneConnect iphone", res)
@@ -392,8 +375,11 @@ def __lldb_init_module(debugger, internal_dict):
     ci.HandleCommand("command script add -f lldbinit.cmd_vm_select_vm vmselect", res)
 
     ci.HandleCommand("command script add -f lldbinit.cmd_cov cov", res)
+    ci.HandleCommand("command script add -f lldbinit.cmd_covconv covconv", res)
     ci.HandleCommand("command script add -f lldbinit.cmd_callz cz", res)
     ci.HandleCommand("command script add -f lldbinit.cmd_callz_regex czr", res)
+    ci.HandleCommand("command script add -f lldbinit.cmd_sample sample", res)
+    ci.HandleCommand("command script add -f lldbinit.cmd_dump dump", res)
     ci.HandleCommand("command script add -f lldbinit.cmd_xu xu", res)
     ci.HandleCommand("command script add -f lldbinit.cmd_aa aa", res)
     ci.HandleCommand("command script add -f lldbinit.cmd_aaa aaa", res)
@@ -459,6 +445,10 @@ def cmd_lldbinitcmds(debugger, command, result, dict):
         [ 'xinfo', 'find address belong to image'],
         [ 'pattern_create', 'create cyclic string'],
         [ 'pattern_offset', 'find offset in cyclic string'],
+        [ 'cov', 'trace function coverage, -b for basic block drcov logs'],
+        [ 'covconv', 'convert a binary coverage trace to text or drcov'],
+        [ 'sample', 'sample the process and write folded stacks for flame graphs'],
+        [ 'dump', 'stream a memory range or vmmap region to a file'],
         
         [ 'showallkexts', 'show all loaded kexts (only for xnu kernel debug)'],
         [ 'kbp', 'set breakpoint at offset for specific kext (only for xnu kernel debug)'],
@@ -528,6 +518,7 @@ Available settings:
  stackwin: enable stack window in context display.
  datawin: enable data window in context display, configure address with datawin.
  flow: call targets and objective-c class/methods.
+ asyncctx: render context in background, only the latest stop is displayed.
  """
 
     global CONFIG_ENABLE_COLOR
@@ -535,6 +526,7 @@ Available settings:
     global CONFIG_DISPLAY_FLOW_WINDOW
     global CONFIG_DISPLAY_DATA_WINDOW
     global CONFIG_NO_CTX
+    global CONFIG_ASYNC_CONTEXT
 
     cmd = command.split()
     if len(cmd) == 0:
@@ -564,6 +556,9 @@ Available settings:
     elif cmd[0] == "ctx":
         CONFIG_NO_CTX = 0
         print("[+] Enabled context.")
+    elif cmd[0] == "asyncctx":
+        CONFIG_ASYNC_CONTEXT = 1
+        print("[+] Enabled background context rendering.")
     elif cmd[0] == "help":
         print(help)
     else:
@@ -586,6 +581,7 @@ Available settings:
  stackwin: disable stack window in context display.
  datawin: enable data window in context display.
  flow: call targets and objective-c class/methods.
+ asyncctx: render context in background, only the latest stop is displayed.
  """
 
     global CONFIG_ENABLE_COLOR
@@ -593,6 +589,7 @@ Available settings:
     global CONFIG_DISPLAY_FLOW_WINDOW
     global CONFIG_DISPLAY_DATA_WINDOW
     global CONFIG_NO_CTX
+    global CONFIG_ASYNC_CONTEXT
 
     cmd = command.split()
     if len(cmd) == 0:
@@ -624,6 +621,9 @@ Available settings:
     elif cmd[0] == "ctx":
         CONFIG_NO_CTX = 1
         print("[+] Disabled context.")
+    elif cmd[0] == "asyncctx":
+        CONFIG_ASYNC_CONTEXT = 0
+        print("[+] Disabled background context rendering.")
     else:
         print("[-] error: unrecognized command.")
         print(help)
@@ -677,20 +677,130 @@ def color(x):
 
 # append data to the output that we display at the end of the hook-stop
 def output(x):
-    global GlobalListOutput
-    GlobalListOutput.append(x)
+    # a context render goes to its own buffer, commands to GlobalListOutput
+    buffer = getattr(render_output, 'buffer', None)
+    if buffer == None:
+        buffer = GlobalListOutput
+    buffer.append(x)
 
 
 # ---------------------------
 # Generate cov
 # ---------------------------
 
+def arm_block_breakpoints(target, blocks):
+    '''One-shot breakpoint on every block head, created once per cov -b run'''
+    block_bps = {}
+    for block_addr in blocks:
+        bp = target.BreakpointCreateByAddress(block_addr)
+        bp.SetOneShot(True)
+        block_bps[block_addr] = bp.GetID()
+    return block_bps
+
+def trace_block_coverage(target, process, thread_id, blocks, heads, block_bps, entry_addr, return_addr):
+    '''
+        Run until the function returns to return_addr. Only the blocks still in
+        block_bps are armed, each block costs a single stop the first time it
+        runs in the whole cov session. Returns the block addresses in the order
+        they were first hit.
+    '''
+    hits = []
+    # the function breakpoint stops after the prologue, inside the first block
+    i = bisect_right(heads, entry_addr) - 1
+    if i >= 0 and entry_addr < heads[i] + blocks[heads[i]] and heads[i] in block_bps:
+        target.BreakpointDelete(block_bps.pop(heads[i]))
+        hits.append(heads[i])
+
+    return_bp = target.BreakpointCreateByAddress(return_addr)
+    return_bp.SetThreadID(thread_id)
+
+    try:
+        while True:
+            process.Continue()
+            if process.GetState() != lldb.eStateStopped:
+                print("[-] error: process is no longer stopped, coverage is partial.")
+                break
+
+            returned = False
+            breakpoint_stop = False
+            for thread in process:
+                if thread.GetStopReason() != lldb.eStopReasonBreakpoint:
+                    continue
+                breakpoint_stop = True
+                pc = thread.GetFrameAtIndex(0).GetPC()
+                # one-shot, lldb already removed it
+                if block_bps.pop(pc, None) != None:
+                    hits.append(pc)
+                if pc == return_addr and thread.GetThreadID() == thread_id:
+                    returned = True
+
+            # signals and exceptions end the trace too
+            if returned or not breakpoint_stop:
+                break
+    finally:
+        target.BreakpointDelete(return_bp.GetID())
+
+    return hits
+
+def cov_basic_blocks(debugger, times):
+    target = debugger.GetSelectedTarget()
+    process = target.GetProcess()
+
+    pc = process.GetSelectedThread().GetFrameAtIndex(0).GetPC()
+    module = lldb.SBAddress(pc, target).module
+    module_path = module.file.fullpath
+    module_base, module_end = get_module_range(target, module)
+
+    blocks = get_basic_blocks(target, module)
+    heads = sorted(blocks)
+    print("[+] {0} basic blocks in {1}".format(len(blocks), module_path))
+
+    block_bps = arm_block_breakpoints(target, blocks)
+    try:
+        for i in range(times):
+            thread = process.GetSelectedThread()
+            entry_addr = thread.GetFrameAtIndex(0).GetPC()
+            return_addr = thread.GetFrameAtIndex(1).GetPC()
+
+            hits = trace_block_coverage(target, process, thread.GetThreadID(), blocks, heads, block_bps,
+                                        entry_addr, return_addr)
+            write_drcov(f"covs/cov{i}.drcov", [(module_base, module_end, module_path)],
+                        [(0, addr - module_base, blocks[addr]) for addr in hits])
+            print(f"[+] {len(hits)} new blocks written to covs/cov{i}.drcov")
+
+            if i + 1 < times:
+                # run to the next call, the function breakpoint is still set
+                process.Continue()
+                if process.GetState() != lldb.eStateStopped:
+                    break
+    finally:
+        for bp_id in block_bps.values():
+            target.BreakpointDelete(bp_id)
+
 def cmd_cov(debugger, command, result, _dict):
+    '''Trace the coverage of a function. Use \'cov help\' for more information.'''
+    help = """
+Trace the coverage of a function, one file per call under covs/.
+
+Syntax: cov [-b] <function_name> [<times>]
+
+By default every instruction is single stepped and recorded to a binary trace (covs/covN.cov),
+use covconv to turn it into module+offset text or a drcov log.
+
+ -b basic block mode, sets a one-shot breakpoint on every block of the function module
+    instead of single stepping and writes drcov logs (covs/covN.drcov) for lighthouse.
+    Each log holds the blocks first covered by that call, load them together for the total.
+"""
     global CONFIG_NO_CTX
 
-    args = command.split(' ')
-    if len(args) < 1:
-        print('cov <function_name> <times>')
+    args = command.split()
+    basic_blocks = False
+    if len(args) > 0 and args[0] == '-b':
+        basic_blocks = True
+        args = args[1:]
+
+    if len(args) < 1 or args[0] == 'help':
+        print(help)
         return
 
     CONFIG_NO_CTX = 1
@@ -700,8 +810,11 @@ def cmd_cov(debugger, command, result, _dict):
         times = int(args[1])
     else:
         times = 1
-    
-    rip = int(str(get_frame().reg["rip"].value), 16)
+
+    # block mode drives the process itself, every continue must wait for the stop
+    is_async = debugger.GetAsync()
+    if basic_blocks:
+        debugger.SetAsync(False)
 
     res = lldb.SBCommandReturnObject()
     lldb.debugger.GetCommandInterpreter().HandleCommand("bpda", res)
@@ -711,6 +824,17 @@ def cmd_cov(debugger, command, result, _dict):
 
     lldb.debugger.GetCommandInterpreter().HandleCommand("c", res)
 
+    if basic_blocks:
+        try:
+            if get_process().GetState() == lldb.eStateStopped:
+                cov_basic_blocks(debugger, times)
+            else:
+                print("[-] error: process didn't stop at " + func_name)
+        finally:
+            debugger.SetAsync(is_async)
+            CONFIG_NO_CTX = 0
+        return
+
     rip = int(str(get_frame().reg["rip"].value), 16)
     target_func = resolve_symbol_name(rip)
     print(target_func)
@@ -718,155 +842,307 @@ def cmd_cov(debugger, command, result, _dict):
     cur_target = debugger.GetSelectedTarget()
     xinfo = resolve_mem_map(cur_target, rip)
     module_name = xinfo["module_name"]
-    module_base = rip - xinfo["abs_offset"]
+    module_base = get_module_range(cur_target, lldb.SBAddress(rip, cur_target).module)[0]
     print(module_name, hex(module_base))
 
     for i in range(times):
-        with open(f"covs/cov{i}.txt", "w") as out:
+        # binary (module_id, offset) records, covconv turns them into text or drcov
+        with CoverageSink(f"covs/cov{i}.cov") as sink:
+            # module name -> (module_id, load address of its header)
+            module_bases = {}
+            # instructions more than 4 GiB past their module base don't fit a record
+            skipped = 0
             while True:
-                # out.write(f"{xinfo['module_name']}+0x{xinfo['abs_offset']:x}\n")
                 # lldb.debugger.GetCommandInterpreter().HandleCommand("ni", res)
                 get_process().selected_thread.StepInstruction(False)
                 rip = int(str(get_frame().reg["rip"].value), 16)
                 xinfo = resolve_mem_map(cur_target, rip)
-                out.write(f"{xinfo['module_name']}+0x{xinfo['abs_offset']:x}\n")
+                # outside any loaded image (jit code, stubs), nothing to record
+                if xinfo['abs_offset'] != -1:
+                    module_name = xinfo['module_name']
+                    if module_name not in module_bases:
+                        # first time in this module, record its range for drcov
+                        module = lldb.SBAddress(rip, cur_target).module
+                        base, end = get_module_range(cur_target, module)
+                        module_id = sink.module_id(module_name, base, end, module.file.fullpath or '')
+                        module_bases[module_name] = (module_id, base)
+                    module_id, base = module_bases[module_name]
+                    try:
+                        sink.add(module_id, rip - base)
+                    except ValueError:
+                        skipped += 1
 
                 if target_func == resolve_symbol_name(rip) and get_mnemonic(rip) == 'ret':
                     lldb.debugger.GetCommandInterpreter().HandleCommand("c", res)
-                    print(f"[+] Written to covs/cov{i}.txt")
+                    if skipped:
+                        print(f"[!] {skipped} instructions out of their module's 4 GiB range were not recorded")
+                    print(f"[+] Written to covs/cov{i}.cov")
                     break
             
 
     CONFIG_NO_CTX = 0
 
+def cmd_covconv(debugger, command, result, _dict):
+    '''Convert a binary coverage trace written by cov. Use \'covconv help\' for more information.'''
+    help = """
+Convert a binary coverage trace written by cov to text or drcov.
 
-def cmd_callz(debugger, command, result, _dict):
-    global CONFIG_NO_CTX
-    CONFIG_NO_CTX = 1
+Syntax: covconv <trace> <text|drcov> [<output>]
 
-    args = command.split(' ')
-    if len(args) < 1:
-        print('cz <module name>')
+ text  : module+offset lines, one per traced instruction (default output <trace>.txt)
+ drcov : drcov log of the unique traced addresses, for lighthouse (default output <trace>.drcov)
+"""
+    args = command.split()
+    if len(args) < 2 or args[1] not in ('text', 'drcov'):
+        print(help)
         return
 
-    module_name = args[0]
-    target = debugger.GetSelectedTarget()
-    module = find_module_by_name(get_target(), module_name)
+    src = args[0]
+    fmt = args[1]
+    if len(args) > 2:
+        dst = args[2]
+    else:
+        dst = os.path.splitext(src)[0] + ('.txt' if fmt == 'text' else '.drcov')
 
-    bpmap = {}
-    print("[+] Creating breakpoints for all symbols in", module_name)
-    for symbol in module:
-        sym_name = symbol.GetName()
-        if sym_name.startswith("os") or "pthread" in sym_name or "lock" in sym_name or "operator" in sym_name:
-            continue
-        address = symbol.GetStartAddress().GetLoadAddress(target)
-        bp = target.BreakpointCreateByAddress(address)
-        bp.SetOneShot(True)
-        bpmap[address] = bp
-    print("[+] Done creating breakpoints for all symbols in", module_name)
+    try:
+        if fmt == 'text':
+            converted = coverage_to_text(src, dst)
+        else:
+            converted = coverage_to_drcov(src, dst)
+    except (IOError, OSError) as e:
+        print("[-] error: {0}".format(e))
+        return
+
+    if not converted:
+        print("[-] error: {0} is not a coverage trace.".format(src))
+        return
+    print("[+] Written to {0}".format(dst))
+
+
+def callz_parser(regex=False):
+    parser = argparse.ArgumentParser(prog="czr" if regex else "cz")
+    parser.add_argument("module", help="Module whose functions are traced")
+    if regex:
+        parser.add_argument("regex", help="Only trace the symbols matching this regex")
+    parser.add_argument("-o", "--output",  help="Stream caller -> callee edges to this file")
+    parser.add_argument("-p", "--profile", action="store_true", help="Count hits quietly, print a hot function table at the end")
+    parser.add_argument("-b", "--budget",  type=int, default=100, help="Profile mode, hits per function before it is disarmed (0 is unlimited)")
+    parser.add_argument("-g", "--graph",   help="Profile mode, write the call graph to this file (.json for JSON, DOT otherwise)")
+    parser.add_argument("-t", "--top",     type=int, default=20, help="Profile mode, rows of the hot function table")
+    return parser
+
+def callz_report(tracer, module_name, args):
+    '''Hot function table and call graph of a profile run'''
+    functions = tracer.hot_functions()
+    print("[+] Hot functions in {0} ({1} functions hit, {2} call edges):".format(
+        module_name, len(functions), len(tracer.edges)))
+    print("{0:>10}  {1}".format("hits", "function"))
+    for hits, address, name in functions[:args.top]:
+        budget_mark = "+" if args.budget and hits >= args.budget else " "
+        print("{0:>10}{1} {2}".format(hits, budget_mark, name))
+    if args.budget and any(hits >= args.budget for hits, address, name in functions):
+        print("[+] + reached the hit budget of {0} and was disarmed".format(args.budget))
+
+    if args.graph:
+        tracer.write_call_graph(args.graph)
+        print("[+] Call graph written to", args.graph)
+
+def callz_trace(debugger, args, pattern=None):
+    '''Trace calls into the module functions, shared by cz and czr'''
+    global CONFIG_NO_CTX
 
-    visited = []
-    while True:
-        get_process().Continue()
+    module_name = args.module
+    target = debugger.GetSelectedTarget()
+    module = find_module_by_name(target, module_name)
+    if not module:
+        print("[-] error: module {0} not found.".format(module_name))
+        return
 
-        thread = get_thread()
-        rip = int(str(get_frame().reg["rip"].value), 16)
+    symbols = get_call_trace_symbols(target, module, pattern)
+    # the first hit of every function is enough unless we profile
+    budget = args.budget if args.profile else 1
+    tracer = CallTracer(target, module, symbols, args.output, budget)
 
-        if rip in visited:
-            continue
-        # visited.append(rip)
-        if rip not in bpmap.keys():
-            print("[+] Dead")
-            break
-        bpmap[rip].SetEnabled(False)
+    print("[+] Creating breakpoints for all symbols in", module_name)
+    count = tracer.arm()
+    print("[+] Done creating breakpoints for {0} symbols in {1}".format(count, module_name))
 
-        print(hex(rip) + ":")
-        for i in range(2):
-            frame = thread.GetFrameAtIndex(i)
-            symbol = frame.GetSymbol()
-            module = frame.GetModule().GetFileSpec().GetFilename()
+    # we drive the process ourselves, every Continue() must wait for the stop
+    CONFIG_NO_CTX = 1
+    is_async = debugger.GetAsync()
+    debugger.SetAsync(False)
+    try:
+        while True:
+            hits = tracer.next_hits(get_process())
+            if not hits:
+                print("[+] Dead")
+                break
+
+            # threads can stop at traced functions together, record all of them
+            for thread, stop_address in hits:
+                tracer.record(thread, stop_address)
+                if args.profile:
+                    continue
+
+                print(hex(stop_address) + ":")
+                for i in range(2):
+                    frame = thread.GetFrameAtIndex(i)
+                    symbol = frame.GetSymbol()
+                    module = frame.GetModule().GetFileSpec().GetFilename()
+
+                    print("|" + "__" * i, module, symbol.GetName())
+    finally:
+        tracer.disarm()
+        debugger.SetAsync(is_async)
+        CONFIG_NO_CTX = 0
 
-            print("|" + "__" * i, module, symbol.GetName())
+    if args.profile:
+        callz_report(tracer, module_name, args)
+    else:
+        print("[+] {0} functions hit, {1} call edges".format(len(tracer.hits), len(tracer.edges)))
+    if args.output:
+        print("[+] Call edges written to", args.output)
+    return tracer
 
-    CONFIG_NO_CTX = 0
+def cmd_callz(debugger, command, result, _dict):
+    args = callz_parser().parse_args(command.split())
+    callz_trace(debugger, args)
 
 def cmd_callz_regex(debugger, command, result, _dict):
-    global CONFIG_NO_CTX
-    CONFIG_NO_CTX = 1
+    args = callz_parser(regex=True).parse_args(command.split())
 
-    args = command.split(' ')
-    if len(args) < 2:
-        print('czr <module> <regex>')
-        return
+    print("[+] Tracing symbols in", args.module, "with regex", args.regex)
+    callz_trace(debugger, args, re.compile(args.regex))
 
-    module_name = args[0]
-    pattern = re.compile(args[1])
-    target = debugger.GetSelectedTarget()
-    module = find_module_by_name(get_target(), module_name)
-
-    bpmap = {}
-    print("[+] Creating breakpoints for all symbols in", module_name, "with regex", args[1])
-    for symbol in module:
-        sym_name = symbol.GetName()
-        match = re.match(pattern, sym_name)
-        if not match:
-            continue
-        if sym_name.startswith("os") or "pthread" in sym_name or "lock" in sym_name or "operator" in sym_name:
+# ---------------------------
+# Sampling profiler
+# ---------------------------
+
+def sample_parser():
+    parser = argparse.ArgumentParser(prog="sample")
+    parser.add_argument("-d", "--duration",  type=float, default=5, help="Seconds to sample for")
+    parser.add_argument("-f", "--frequency", type=float, default=100, help="Samples per second")
+    parser.add_argument("-o", "--output",    default="sample.folded", help="Folded stacks output file")
+    parser.add_argument("-m", "--max-depth", type=int, default=128, help="Frames kept per stack")
+    parser.add_argument("-t", "--thread-names", action="store_true", help="Root every stack at its thread name")
+    return parser
+
+def sample_stacks(process, args, stacks, symbols):
+    '''Walk every thread of the stopped process, folding its frames into stacks'''
+    for thread in process:
+        names = []
+        # GetNumFrames() unwinds the whole stack, stop at max_depth instead
+        for i in range(args.max_depth):
+            frame = thread.GetFrameAtIndex(i)
+            if not frame.IsValid():
+                break
+            pc = frame.GetPC()
+            name = symbols.get(pc)
+            if name == None:
+                # one symbol lookup per pc for the whole run
+                symbol_name = resolve_symbol_name(pc) or hex(pc)
+                module_name = os.path.basename(get_module_name(pc))
+                name = "{0}`{1}".format(module_name, symbol_name) if module_name else symbol_name
+                # ; separates frames in the folded format
+                name = name.replace(";", ":")
+                symbols[pc] = name
+            names.append(name)
+
+        if not names:
             continue
-        address = symbol.GetStartAddress().GetLoadAddress(target)
-        bp = target.BreakpointCreateByAddress(address)
-        bp.SetOneShot(True)
-        bpmap[address] = bp
-    print("[+] Done creating breakpoints for all symbols in", module_name)
+        names.reverse()
+        if args.thread_names:
+            names.insert(0, thread.GetName() or "thread-{0}".format(thread.GetThreadID()))
 
-    visited = []
-    while True:
-        get_process().Continue()
+        stack = ";".join(names)
+        stacks[stack] = stacks.get(stack, 0) + 1
 
-        thread = get_thread()
-        rip = int(str(get_frame().reg["rip"].value), 16)
+def cmd_sample(debugger, command, result, _dict):
+    '''Sample the running process and write folded stacks for flame graphs. Use \'sample -h\' for more information.'''
+    global CONFIG_NO_CTX
 
-        if rip in visited:
-            continue
-        # visited.append(rip)
-        if rip not in bpmap.keys():
-            print("[+] Dead")
-            break
-        bpmap[rip].SetEnabled(False)
+    args = sample_parser().parse_args(command.split())
+    if args.frequency <= 0 or args.duration <= 0:
+        print("[-] error: duration and frequency must be positive.")
+        return
 
-        print(hex(rip) + ":")
-        for i in range(2):
-            frame = thread.GetFrameAtIndex(i)
-            symbol = frame.GetSymbol()
-            module = frame.GetModule().GetFileSpec().GetFilename()
+    process = get_process()
+    if not process or process.GetState() != lldb.eStateStopped:
+        print("[-] error: sample needs a stopped process.")
+        return
 
-            print("|" + "__" * i, module, symbol.GetName())
+    interval = 1.0 / args.frequency
+    stacks = {}
+    symbols = {}
+    samples = 0
 
-    CONFIG_NO_CTX = 0
+    # every sample is a stop, don't draw the context for them
+    saved_no_ctx = CONFIG_NO_CTX
+    CONFIG_NO_CTX = 1
+    # in sync mode Continue() consumes the stop events itself, so lldb doesn't
+    # print a stop message per sample, a timer thread does the interrupting
+    is_async = debugger.GetAsync()
+    debugger.SetAsync(False)
+    try:
+        start = time.time()
+        deadline = start + args.duration
+        next_sample = start
+        while True:
+            next_sample += interval
+            timer = threading.Timer(max(0, next_sample - time.time()), process.SendAsyncInterrupt)
+            timer.start()
+            process.Continue()
+            timer.cancel()
+
+            if process.GetState() != lldb.eStateStopped:
+                print("[-] error: process is gone, stopped sampling.")
+                break
+
+            sample_stacks(process, args, stacks, symbols)
+            samples += 1
+            if time.time() >= deadline:
+                break
+    finally:
+        debugger.SetAsync(is_async)
+        CONFIG_NO_CTX = saved_no_ctx
+
+    with open(args.output, "w") as f:
+        for stack, count in sorted(stacks.items()):
+            f.write("{0} {1}\n".format(stack, count))
+
+    elapsed = time.time() - start
+    print("[+] {0} samples in {1:.1f}s ({2:.0f} Hz), {3} unique stacks written to {4}".format(
+        samples, elapsed, samples / elapsed if elapsed else 0, len(stacks), args.output))
+
+    # leaf frames are where the time is spent
+    leaves = {}
+    for stack, count in stacks.items():
+        leaf = stack.rsplit(";", 1)[-1]
+        leaves[leaf] = leaves.get(leaf, 0) + count
+    total = sum(leaves.values())
+    for leaf, count in sorted(leaves.items(), key=lambda l: -l[1])[:10]:
+        print("{0:6.1f}%  {1}".format(100.0 * count / total, leaf))
 
 def cmd_xu(debugger, command, result, _dict):
-    args = command.split(' ')
-    if len(args) < 1:
-        print('xu <expression>')
+    args = command.split()
+    if len(args) < 1 or len(args) > 2:
+        print('xu <expression> [max_length]')
         return
 
-    addr = int(get_frame().EvaluateExpression(args[0]).GetValue(), 10)
-    error = lldb.SBError()
+    addr = evaluate(args[0])
+    if not addr:
+        print(f'Your address "{args[0]}" is invalid')
+        return
 
-    ended = False
-    s = u''
-    offset = 0
-
-    while not ended:
-        mem = get_target().GetProcess().ReadMemory(addr + offset, 100, error)
-        for i in range(0, 100, 2):
-            wc = mem[i+1] << 8 | mem[i]
-            s += chr(wc)
-            if wc == 0:
-                ended = True
-                break
+    max_length = parse_number(args[1]) if len(args) == 2 else 0x1000
+    if max_length <= 0:
+        print('Invalid max_length')
+        return
 
-        offset += 100
+    s = read_string(addr, max_length, 'utf-16')
+    if s == None:
+        print("[-] error: failed to read memory at {0}.".format(hex(addr)))
+        return
 
     print(s)
 
@@ -1173,6 +1449,7 @@ Note: control flow is not respected, it advances to next instruction in memory.
         get_frame().reg["rip"].value = format(next_addr, '#x')
     elif is_i386():
         get_frame().reg["eip"].value = format(next_addr, '#x')
+    invalidate_stop_context()
     # show the updated context
     lldb.debugger.HandleCommand("context")
 
@@ -1227,6 +1504,8 @@ Note: expressions supported, do not use spaces between operators.
     
     patch_bytes = str('\xCC')
     result = target.GetProcess().WriteMemory(int3_addr, patch_bytes, error)
+    invalidate_memory_cache()
+    invalidate_instruction_cache()
     if error.Success() == False:
         print("[-] error: Failed to write memory at 0x{:x}.".format(int3_addr))
         return
@@ -1295,6 +1574,8 @@ Note: expressions supported, do not use spaces between operators.
             return
         patch_bytes = chr(original_byte)
         result = target.GetProcess().WriteMemory(int3_addr, patch_bytes, error)
+        invalidate_memory_cache()
+        invalidate_instruction_cache()
         if error.Success() == False:
             print("[-] error: Failed to write memory at 0x{:x}.".format(int3_addr))
             return
@@ -1388,6 +1669,8 @@ Note: expressions supported, do not use spaces between operators.
     # can we do better here? WriteMemory takes an input string... weird
     for i in range(patch_size):
         result = target.GetProcess().WriteMemory(current_patch_addr, patch_bytes, error)
+        invalidate_memory_cache()
+        invalidate_instruction_cache()
         if error.Success() == False:
             print("[-] error: Failed to write memory at 0x{:x}.".format(current_patch_addr))
             return
@@ -1446,6 +1729,8 @@ Note: expressions supported, do not use spaces between operators.
     # can we do better here? WriteMemory takes an input string... weird
     for i in xrange(patch_size):
         result = target.GetProcess().WriteMemory(current_patch_addr, patch_bytes, error)
+        invalidate_memory_cache()
+        invalidate_instruction_cache()
         if error.Success() == False:
             print("[-] error: Failed to write memory at 0x{:x}.".format(current_patch_addr))
             return
@@ -1631,6 +1916,7 @@ You probably want to use this at the top of the function you want to return from
     return_value = frame.reg["rax"]
     return_value.value = str(value)
     get_thread().ReturnFromFrame(frame, return_value)
+    invalidate_stop_context()
 
 # set a breakpoint with return command associated when hit
 def cmd_crackcmd(debugger, command, result, dict):
@@ -1816,179 +2102,105 @@ def crackcmd_noret_callback(frame, bp_loc, internal_dict):
 '''
     Output nice memory hexdumps...
 '''
-# display byte values and ASCII characters
-def cmd_db(debugger, command, result, dict):
-    '''Display hex dump in byte values and ASCII characters. Use \'db help\' for more information.'''
-    help = """
-Display memory hex dump in byte length and ASCII representation.
-
-Syntax: db [<address>]
-
-Note: if no address specified it will dump current instruction pointer address.
-Note: expressions supported, do not use spaces between operators.
-"""
-
-    global GlobalListOutput
-    GlobalListOutput = []
-        
+def parse_dump_args(command, help):
+    '''Start address and length of a db/dw/dd/dq command, None when they're invalid'''
     cmd = command.split()
 
     if len(cmd) == 0:
         dump_addr = get_current_pc()
         if not dump_addr:
             print("[-] error: invalid current address.")
-            return
-    elif len(cmd) == 1:
-        if cmd[0] == "help":
-            print(help)
-            return
-        dump_addr = evaluate(cmd[0])
-        if not dump_addr:
-            print("[-] error: invalid input address value.")
-            print("")
-            print(help)
-            return
-    else:
+            return None
+        return dump_addr, 0x100
+
+    if cmd[0] == "help":
+        print(help)
+        return None
+    if len(cmd) > 2:
         print("[-] error: please insert a start address.")
         print("")
         print(help)
-        return
+        return None
 
-    membuff = try_read_mem(dump_addr, 0x100)
-    if not membuff:
+    dump_addr = evaluate(cmd[0])
+    if not dump_addr:
+        print("[-] error: invalid input address value.")
+        print("")
+        print(help)
+        return None
+
+    length = 0x100
+    if len(cmd) == 2:
+        length = evaluate(cmd[1])
+        if not length or length < 0:
+            print("[-] error: invalid input length value.")
+            print("")
+            print(help)
+            return None
+    return dump_addr, length
+
+def dump_memory(result, dump_addr, length, unit, width, rule, middle=None, ascii=True):
+    '''Hex dump whole rows covering length bytes from dump_addr'''
+    global GlobalListOutput
+    GlobalListOutput = []
+
+    length = (length + width - 1) // width * width
+    membuff, mask = read_mem_masked(dump_addr, length)
+    if b'\x01' not in mask:
         print('[-] error: Your {0} address is not readable'.format(hex(dump_addr)))
         return
-    membuff = membuff.ljust(0x100, b'\x00')
 
+    pointer_size = get_pointer_size()
     color("BLUE")
-    if get_pointer_size() == 4:
+    if pointer_size == 4:
         output("[0x0000:0x%.08X]" % dump_addr)
-        output("------------------------------------------------------")
     else:
         output("[0x0000:0x%.016lX]" % dump_addr)
-        output("------------------------------------------------------")
+    output(rule)
     color("BOLD")
     output("[data]")
     color("RESET")
     output("\n")
-    #output(hexdump(dump_addr, membuff, " ", 16));
-    index = 0
-    while index < 0x100:
-        data = struct.unpack(b"B"*16, membuff[index:index+0x10])
-        if get_pointer_size() == 4:
-            szaddr = "0x%.08X" % dump_addr
-        else:
-            szaddr = "0x%.016lX" % dump_addr
-        fmtnice = "%.02X %.02X %.02X %.02X %.02X %.02X %.02X %.02X"
-        fmtnice = fmtnice + " - " + fmtnice
-        output("\033[1m%s :\033[0m %.02X %.02X %.02X %.02X %.02X %.02X %.02X %.02X - %.02X %.02X %.02X %.02X %.02X %.02X %.02X %.02X \033[1m%s\033[0m" % 
-            (szaddr, 
-            data[0], 
-            data[1], 
-            data[2], 
-            data[3], 
-            data[4], 
-            data[5], 
-            data[6], 
-            data[7], 
-            data[8], 
-            data[9], 
-            data[10], 
-            data[11], 
-            data[12], 
-            data[13], 
-            data[14], 
-            data[15], 
-            quotechars(membuff[index:index+0x10])));
-        if index + 0x10 != 0x100:
-            output("\n")
-        index += 0x10
-        dump_addr += 0x10
+    output("\n".join(hexdump_lines(dump_addr, membuff, unit, width, pointer_size, mask, middle=middle, ascii=ascii)))
     color("RESET")
-    #last element of the list has all data output...
-    #so we remove last \n
     result.PutCString("".join(GlobalListOutput))
     result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
 
+# display byte values and ASCII characters
+def cmd_db(debugger, command, result, dict):
+    ''' Display hex dump in byte values and ASCII characters. Use \'db help\' for more information.'''
+    help = """
+Display memory hex dump in byte length and ASCII representation.
+
+Syntax: db [<address>] [<length>]
+
+Note: if no address specified it will dump current instruction pointer address.
+Note: length defaults to 0x100 bytes.
+Note: expressions supported, do not use spaces between operators.
+"""
+
+    args = parse_dump_args(command, help)
+    if args == None:
+        return
+    dump_memory(result, args[0], args[1], 1, 0x10, "------------------------------------------------------", middle=" - ")
+
 # display word values and ASCII characters
 def cmd_dw(debugger, command, result, dict):
     ''' Display hex dump in word values and ASCII characters. Use \'dw help\' for more information.'''
     help = """
 Display memory hex dump in word length and ASCII representation.
 
-Syntax: dw [<address>]
+Syntax: dw [<address>] [<length>]
 
 Note: if no address specified it will dump current instruction pointer address.
+Note: length defaults to 0x100 bytes.
 Note: expressions supported, do not use spaces between operators.
 """
 
-    global GlobalListOutput
-    GlobalListOutput = []
-
-    cmd = command.split()
-
-    if len(cmd) == 0:
-        dump_addr = get_current_pc()
-        if dump_addr == 0:
-            print("[-] error: invalid current address.")
-            return
-    elif len(cmd) == 1:
-        if cmd[0] == "help":
-           print(help)
-           return
-        dump_addr = evaluate(cmd[0])
-        if dump_addr == None:
-            print("[-] error: invalid input address value.")
-            print("")
-            print(help)
-            return
-    else:
-        print("[-] error: please insert a start address.")
-        print("")
-        print(help)
-        return
-
-    membuff = try_read_mem(dump_addr, 0x100)
-    if not membuff:
-        print('[-] error: Your {0} address is not readable'.format(hex(dump_addr)))
+    args = parse_dump_args(command, help)
+    if args == None:
         return
-    membuff = membuff.ljust(0x100, b'\x00')
-
-    color("BLUE")
-    if get_pointer_size() == 4: #is_i386() or is_arm():
-        output("[0x0000:0x%.08X]" % dump_addr)
-        output("--------------------------------------------")
-    else: #is_x64():
-        output("[0x0000:0x%.016lX]" % dump_addr)
-        output("--------------------------------------------")
-    color("BOLD")
-    output("[data]")
-    color("RESET")
-    output("\n")
-    index = 0
-    while index < 0x100:
-        data = struct.unpack("HHHHHHHH", membuff[index:index+0x10])
-        if get_pointer_size() == 4:
-            szaddr = "0x%.08X" % dump_addr
-        else:
-            szaddr = "0x%.016lX" % dump_addr
-        output("\033[1m%s :\033[0m %.04X %.04X %.04X %.04X %.04X %.04X %.04X %.04X \033[1m%s\033[0m" % (szaddr, 
-            data[0],
-            data[1],
-            data[2],
-            data[3],
-            data[4],
-            data[5],
-            data[6],
-            data[7],
-            quotechars(membuff[index:index+0x10])));
-        if index + 0x10 != 0x100:
-            output("\n")
-        index += 0x10
-        dump_addr += 0x10
-    color("RESET")
-    result.PutCString("".join(GlobalListOutput))
-    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+    dump_memory(result, args[0], args[1], 2, 0x10, "--------------------------------------------")
 
 # display dword values and ASCII characters
 def cmd_dd(debugger, command, result, dict):
@@ -1996,75 +2208,17 @@ def cmd_dd(debugger, command, result, dict):
     help = """
 Display memory hex dump in double word length and ASCII representation.
 
-Syntax: dd [<address>]
+Syntax: dd [<address>] [<length>]
 
 Note: if no address specified it will dump current instruction pointer address.
+Note: length defaults to 0x100 bytes.
 Note: expressions supported, do not use spaces between operators.
 """
 
-    global GlobalListOutput
-    GlobalListOutput = []
-
-    cmd = command.split()
-
-    if len(cmd) == 0:
-        dump_addr = get_current_pc()
-        if dump_addr == 0:
-            print("[-] error: invalid current address.")
-            return
-    elif len(cmd) == 1:
-        if cmd[0] == "help":
-           print(help)
-           return
-        dump_addr = evaluate(cmd[0])
-        if not dump_addr:
-            print("[-] error: invalid input address value.")
-            print("")
-            print(help)
-            return
-    else:
-        print("[-] error: please insert a start address.")
-        print("")
-        print(help)
-        return
-
-    membuff = try_read_mem(dump_addr, 0x100)
-    if not membuff:
-        print('[-] error: Your {0} address is not readable'.format(hex(dump_addr)))
+    args = parse_dump_args(command, help)
+    if args == None:
         return
-    membuff = membuff.ljust(0x100, b'\x00')
-
-    color("BLUE")
-    if get_pointer_size() == 4: #is_i386() or is_arm():
-        output("[0x0000:0x%.08X]" % dump_addr)
-        output("----------------------------------------")
-    else: #is_x64():
-        output("[0x0000:0x%.016lX]" % dump_addr)
-        output("----------------------------------------")
-    color("BOLD")
-    output("[data]")
-    color("RESET")
-    output("\n")
-    index = 0
-    while index < 0x100:
-        (mem0, mem1, mem2, mem3) = struct.unpack("IIII", membuff[index:index+0x10])
-        if get_pointer_size() == 4: #is_i386() or is_arm():
-            szaddr = "0x%.08X" % dump_addr
-        else:  #is_x64():
-            szaddr = "0x%.016lX" % dump_addr
-        output("\033[1m%s :\033[0m %.08X %.08X %.08X %.08X \033[1m%s\033[0m" % (szaddr, 
-                                            mem0, 
-                                            mem1, 
-                                            mem2, 
-                                            mem3, 
-                                            quotechars(membuff[index:index+0x10])));
-        if index + 0x10 != 0x100:
-            output("\n")
-        index += 0x10
-        dump_addr += 0x10
-    color("RESET")
-    result.PutCString("".join(GlobalListOutput))
-    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+    dump_memory(result, args[0], args[1], 4, 0x10, "----------------------------------------")
 
 # display quad values
 def cmd_dq(debugger, command, result, dict):
@@ -2072,76 +2226,186 @@ def cmd_dq(debugger, command, result, dict):
     help = """
 Display memory hex dump in quad word length.
 
-Syntax: dq [<address>]
+Syntax: dq [<address>] [<length>]
 
 Note: if no address specified it will dump current instruction pointer address.
+Note: length defaults to 0x100 bytes.
 Note: expressions supported, do not use spaces between operators.
 """
 
-    global GlobalListOutput
-    GlobalListOutput = []
+    args = parse_dump_args(command, help)
+    if args == None:
+        return
+    dump_memory(result, args[0], args[1], 8, 0x20, "-------------------------------------------------------", ascii=False)
+
+def dump_parser():
+    parser = argparse.ArgumentParser(prog="dump")
+    parser.add_argument("start", help="Start address expression or vmmap region name")
+    parser.add_argument("size", nargs="?", help="Bytes to dump, default is up to the end of the region")
+    parser.add_argument("-o", "--output", default="dump.bin", help="Raw output file, unreadable bytes are zero filled")
+    parser.add_argument("-x", "--hexdump", help="Also write a hexdump text to this file")
+    parser.add_argument("-H", "--holes", action="store_true", help="List unreadable ranges in <output>.holes")
+    parser.add_argument("-c", "--chunk-size", default=hex(DUMP_CHUNK_SIZE), help="Bytes read from the target at once")
+    return parser
+
+def dump_region_spans(name):
+    '''[start, end] ranges of the vmmap regions called name, contiguous mappings are merged'''
+    spans = []
+    for map_info in get_memory_maps():
+        if name.lower() not in (map_info.type.lower(), os.path.basename(map_info.region).lower()):
+            continue
+        if spans and spans[-1][1] == map_info.start:
+            spans[-1][1] = map_info.end
+        else:
+            spans.append([map_info.start, map_info.end])
+    return spans
 
-    cmd = command.split()
+def cmd_dump(debugger, command, result, _dict):
+    '''Stream a memory range or vmmap region to a file. Use \'dump -h\' for more information.'''
+    args = dump_parser().parse_args(command.split())
 
-    if len(cmd) == 0:
-        dump_addr = get_current_pc()
-        if dump_addr == 0:
-            print("[-] error: invalid current address.")
-            return
-    elif len(cmd) == 1:
-        if cmd[0] == "help":
-           print(help)
-           return        
-        dump_addr = evaluate(cmd[0])
-        if not dump_addr:
-            print("[-] error: invalid input address value.")
-            print("")
-            print(help)
-            return
-    else:
-        print("[-] error: please insert a start address.")
-        print("")
-        print(help)
+    process = get_process()
+    if not process or process.GetState() != lldb.eStateStopped:
+        print("[-] error: dump needs a stopped process.")
         return
 
-    membuff = try_read_mem(dump_addr, 0x100)
-    if not membuff:
-        print('[-] error: Your {0} address is not readable'.format(hex(dump_addr)))
+    chunk_size = parse_number(args.chunk_size)
+    if chunk_size <= 0:
+        print("[-] error: invalid chunk size.")
         return
+    # keep hexdump rows aligned across chunks
+    chunk_size = (chunk_size + 0xf) & ~0xf
 
-    membuff = membuff.ljust(0x100, b'\x00')
-
-    color("BLUE")
-    if get_pointer_size() == 4:
-        output("[0x0000:0x%.08X]" % dump_addr)
-        output("-------------------------------------------------------")
+    # a region name dumps the whole region, an address up to the end of its region
+    spans = dump_region_spans(args.start)
+    if len(spans) > 1:
+        print("[-] error: {0} names {1} ranges, dump one by address:".format(args.start, len(spans)))
+        for span_start, span_end in spans:
+            print("    {0} - {1}".format(hex(span_start), hex(span_end)))
+        return
+    if spans:
+        start, end = spans[0]
     else:
-        output("[0x0000:0x%.016lX]" % dump_addr)
-        output("-------------------------------------------------------")
-    color("BOLD")
-    output("[data]")
-    color("RESET")
-    output("\n")   
-    index = 0
-    while index < 0x100:
-        (mem0, mem1, mem2, mem3) = struct.unpack("QQQQ", membuff[index:index+0x20])
-        if get_pointer_size() == 4:
-            szaddr = "0x%.08X" % dump_addr
-        else:
-            szaddr = "0x%.016lX" % dump_addr
-        output("\033[1m%s :\033[0m %.016lX %.016lX %.016lX %.016lX" % (szaddr, mem0, mem1, mem2, mem3))
-        if index + 0x20 != 0x100:
-            output("\n")
-        index += 0x20
-        dump_addr += 0x20
-    color("RESET")
-    result.PutCString("".join(GlobalListOutput))
-    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+        start = evaluate(args.start)
+        if not start:
+            print("[-] error: invalid start address or region name.")
+            return
+        map_info = query_vmmap(start)
+        end = map_info.end if map_info else 0
+
+    if args.size != None:
+        size = evaluate(args.size)
+        if not size or size < 0:
+            print("[-] error: invalid dump size.")
+            return
+        end = start + size
+    if end <= start:
+        print("[-] error: {0} isn't in a known region, give a size.".format(hex(start)))
+        return
+
+    total = end - start
+    pointer_size = get_pointer_size()
+    # the last hole stays open until readable bytes follow it
+    hole = None
+    holes = 0
+    unreadable = 0
+    written = 0
+    outputs = []
+    try:
+        raw_file = open(args.output, "wb")
+        outputs.append(raw_file)
+        hexdump_file = None
+        if args.hexdump:
+            hexdump_file = open(args.hexdump, "w")
+            outputs.append(hexdump_file)
+        holes_file = None
+        if args.holes:
+            holes_file = open(args.output + ".holes", "w")
+            outputs.append(holes_file)
+
+        for addr, data, mask in read_mem_chunks(start, end, chunk_size, process):
+            raw_file.write(data)
+            if hexdump_file:
+                lines = hexdump_lines(addr, data, 1, 16, pointer_size, mask, middle=" - ", colored=False)
+                hexdump_file.write("\n".join(lines) + "\n")
+
+            for hole_start, hole_end in mask_holes(addr, mask):
+                if hole and hole[1] == hole_start:
+                    hole = (hole[0], hole_end)
+                    continue
+                if hole and holes_file:
+                    holes_file.write("{0}-{1}\n".format(hex(hole[0]), hex(hole[1])))
+                hole = (hole_start, hole_end)
+                holes += 1
+            unreadable += mask.count(0)
+
+            written += len(data)
+            sys.stdout.write("\r[+] Dumped {0} / {1} bytes ({2}%)".format(hex(written), hex(total), written * 100 // total))
+            sys.stdout.flush()
+        sys.stdout.write("\n")
+
+        if hole and holes_file:
+            holes_file.write("{0}-{1}\n".format(hex(hole[0]), hex(hole[1])))
+    except (IOError, OSError) as e:
+        print("\n[-] error: {0}".format(e))
+        return
+    finally:
+        for f in outputs:
+            f.close()
+
+    print("[+] Wrote {0} - {1} to {2}, {3} unreadable bytes in {4} holes".format(
+        hex(start), hex(end), args.output, hex(unreadable), holes))
+
+def findmem_parser():
+    parser = argparse.ArgumentParser(prog="lldb")
+    parser.add_argument("-s", "--string",  action="append", default=[], help="Search string")
+    parser.add_argument("-u", "--unicode", action="append", default=[], help="Search unicode string")
+    parser.add_argument("-b", "--binary",  action="append", default=[], help="Serach binary string")
+    parser.add_argument("-d", "--dword",   action="append", default=[], help="Find dword (native packing)")
+    parser.add_argument("-q", "--qword",   action="append", default=[], help="Find qword (native packing)")
+    parser.add_argument("-f", "--file" ,   action="append", default=[], help="Load find pattern from file")
+    parser.add_argument("-p", "--patterns", help="Load a pattern set from file, one set of findmem options per line")
+    parser.add_argument("-c", "--count",   help="How many occurances to find, default is all")
+    return parser
+
+# build the list of (label, bytes) patterns from parsed findmem options
+def findmem_patterns(args):
+    patterns = []
+    for string in args.string:
+        patterns.append(("-s " + string, string.encode('utf-8')))
+    for string in args.unicode:
+        patterns.append(("-u " + string, string.encode('utf-16-le')))
+    for binary in args.binary:
+        try:
+            patterns.append(("-b " + binary, bytes.fromhex(binary)))
+        except ValueError:
+            print("[-] Error parsing binary string : " + binary)
+            return None
+    for expr in args.dword:
+        dword = evaluate(expr)
+        if not dword:
+            print("[-] Error evaluating : " + expr)
+            return None
+        patterns.append(("-d " + expr, struct.pack("I", dword & 0xffffffff)))
+    for expr in args.qword:
+        qword = evaluate(expr)
+        if not qword:
+            print("[-] Error evaluating : " + expr)
+            return None
+        patterns.append(("-q " + expr, struct.pack("Q", qword & 0xffffffffffffffff)))
+    for filename in args.file:
+        try:
+            with open(filename, "rb") as f:
+                patterns.append(("-f " + filename, f.read()))
+        except:
+            print("[-] Failed to open file : " + filename)
+            return None
+    return patterns
 
 # XXX: help
 def cmd_findmem(debugger, command, result, dict):
     '''Search memory'''
-    help == """
+    help = """
 [options]
  -s searches for specified string
  -u searches for specified unicode string
@@ -2149,54 +2413,49 @@ def cmd_findmem(debugger, command, result, dict):
  -d searches dword  (eg. -d 0x41414141)
  -q searches qword  (eg. -d 0x4141414141414141)
  -f loads patern from file if it's tooooo big to fit into any of specified options
+ -p loads a pattern set from file, each line holds any of the options above (eg. -q 0x4141414141414141)
  -c specify if you want to find N occurances (default is all)
+
+Every option can be repeated, all the patterns are then matched in a single pass over memory
+and each hit is tagged with the pattern it matched. Hits never overlap, when several patterns
+match at the same address the longest one is reported.
  """
 
     global GlobalListOutput
     GlobalListOutput = []
 
     arg = str(command)
-    parser = argparse.ArgumentParser(prog="lldb")
-    parser.add_argument("-s", "--string",  help="Search string")
-    parser.add_argument("-u", "--unicode", help="Search unicode string")
-    parser.add_argument("-b", "--binary",  help="Serach binary string")
-    parser.add_argument("-d", "--dword",   help="Find dword (native packing)")
-    parser.add_argument("-q", "--qword",   help="Find qword (native packing)")
-    parser.add_argument("-f", "--file" ,   help="Load find pattern from file")
-    parser.add_argument("-c", "--count",   help="How many occurances to find, default is all")
+    parser = findmem_parser().parse_args(arg.split())
 
-    parser = parser.parse_args(arg.split())
-    
-    if parser.string != None:
-        search_string = parser.string
-    elif parser.unicode != None:
-        search_string  = unicode(parser.unicode)
-    elif parser.binary != None:
-        search_string = parser.binary.decode("hex")
-    elif parser.dword != None:
-        dword = evaluate(parser.dword)
-        if not dword:
-            print("[-] Error evaluating : " + parser.dword)
-            return
-        search_string = struct.pack("I", dword & 0xffffffff)
-    elif parser.qword != None:
-        qword = evaluate(parser.qword)
-        if not qword:
-            print("[-] Error evaluating : " + parser.qword)
-            return
-        search_string = struct.pack("Q", qword & 0xffffffffffffffff)
-    elif parser.file != None:
-        f = 0
+    patterns = findmem_patterns(parser)
+    if patterns == None:
+        return
+
+    if parser.patterns != None:
         try:
-            f = open(parser.file, "rb")
+            f = open(parser.patterns, "r")
         except:
-            print("[-] Failed to open file : " + parser.file)
+            print("[-] Failed to open file : " + parser.patterns)
             return
-        search_string = f.read()
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            line_patterns = findmem_patterns(findmem_parser().parse_args(line.split()))
+            if line_patterns == None:
+                f.close()
+                return
+            patterns.extend(line_patterns)
         f.close()
-    else:
-        print("[-] Wrong option... use findmem --help")
+
+    if not patterns:
+        print(help)
         return
+
+    for label, search_string in patterns:
+        if not search_string:
+            print("[-] error: empty search pattern : " + label)
+            return
     
     count = -1
     if parser.count != None:
@@ -2204,73 +2463,34 @@ def cmd_findmem(debugger, command, result, dict):
         if not count:
             print("[-] Error evaluating count : " + parser.count)
             return
-    
+
+    matcher = PatternSet([pattern for label, pattern in patterns])
+
     process = get_process()
-    pid = process.GetProcessID()
-    output_data = subprocess.check_output(["/usr/bin/vmmap", "%d" % pid])
-    lines = output_data.split("\n")
-    #print(lines);
-    #this relies on output from /usr/bin/vmmap so code is dependant on that 
-    #only reason why it's used is for better description of regions, which is
-    #nice to have. If they change vmmap in the future, I'll use my version 
-    #and that output is much easier to parse...
-    newlines = []
-    for x in lines:
-        p = re.compile("([\S\s]+)\s([\da-fA-F]{16}-[\da-fA-F]{16}|[\da-fA-F]{8}-[\da-fA-F]{8})")
-        m = p.search(x)
-        if not m: continue
-        tmp = []
-        mem_name  = m.group(1)
-        mem_range = m.group(2)
-        #0x000000-0x000000
-        mem_start = long(mem_range.split("-")[0], 16)
-        mem_end   = long(mem_range.split("-")[1], 16)
-        tmp.append(mem_name)
-        tmp.append(mem_start)
-        tmp.append(mem_end)
-        newlines.append(tmp)
-    
-    lines = sorted(newlines, key=lambda sortnewlines: sortnewlines[1])
-    #move line extraction a bit up, thus we can latter sort it, as vmmap gives
-    #readable pages only, and then writable pages, so it looks ugly a bit :)
-    newlines = []
+    # only readable regions, already sorted by address
+    lines = [map_info for map_info in get_memory_maps() if map_info.perm.startswith('r')]
+
+    if get_pointer_size() == 4:
+        ptrformat = "%.08X"
+    else:
+        ptrformat = "%.016lX"
+    ptrpadding = " " * len(ptrformat % 0)
+
     for x in lines:
-        mem_name = x[0]
-        mem_start= x[1]
-        mem_end  = x[2]
-        mem_size = mem_end - mem_start
-    
-        err = lldb.SBError()
-                
-        membuff = process.ReadMemory(mem_start, mem_size, err)
-        if err.Success() == False:
-            #output(str(err));
-            #result.PutCString("".join(GlobalListOutput));
-            continue
-        off = 0
+        mem_name = x.type
+        mem_start= x.start
         base_displayed = 0
 
-        while True:
-            if count == 0: 
-                return
-            idx = membuff.find(search_string)
-            if idx == -1: 
-                break
-            if count != -1:
-                count = count - 1
-            off += idx
-    
+        # regions are streamed in fixed-size windows and hits reported as they are found
+        for hit_addr, pattern_id in find_in_region(process, mem_start, x.end, matcher):
+            off = hit_addr - mem_start
+
             GlobalListOutput = []
-            
-            if get_pointer_size() == 4:
-                ptrformat = "%.08X"
-            else:
-                ptrformat = "%.016lX"
 
             color("RESET")
             output("Found at : ")
             color("GREEN")
-            output(ptrformat % (mem_start + off))
+            output(ptrformat % hit_addr)
             color("RESET")
             if base_displayed == 0:
                 output(" base : ")
@@ -2280,16 +2500,20 @@ def cmd_findmem(debugger, command, result, dict):
                 base_displayed = 1
             else:
                 output("        ")
-                if get_pointer_size() == 4:
-                    output(" " * 8)
-                else:
-                    output(" " * 16)
+                output(ptrpadding)
             #well if somebody allocated 4GB of course offset will be to small to fit here
             #but who cares...
             output(" off : %.08X %s" % (off, mem_name))
+            if len(patterns) > 1:
+                color("CYAN")
+                output(" [%s]" % patterns[pattern_id][0])
+                color("RESET")
             print("".join(GlobalListOutput))
-            membuff = membuff[idx+len(search_string):]
-            off += len(search_string)
+
+            if count != -1:
+                count = count - 1
+                if count == 0:
+                    return
     return
 
 def cmd_datawin(debugger, command, result, dict):
@@ -2380,9 +2604,8 @@ def cmd_telescope(debugger, command, result, dict):
     process = debugger.GetSelectedTarget().GetProcess()
     pointer_size = get_pointer_size()
 
-    error_ref = lldb.SBError()
-    memory = process.ReadMemory(address, length * pointer_size, error_ref)
-    if error_ref.Success():
+    memory = read_memory(process, address, length * pointer_size)
+    if memory != None:
         
         # print telescope memory
         for i in range(length):
@@ -2414,10 +2637,7 @@ def cmd_telescope(debugger, command, result, dict):
                                 COLORS['BOLD'], module_name, hex(xinfo['abs_offset']), COLORS['RESET']
                             ))
                 else:
-                    error_ref2 = lldb.SBError()
-                    process.ReadMemory(ptr_value, 1, error_ref2)
-
-                    if error_ref2.Success():
+                    if read_memory(process, ptr_value, 1) != None:
                         # check this address is on heap or stack or mapped address
                         map_info = query_vmmap(ptr_value)
                         if map_info == None:
@@ -2468,25 +2688,13 @@ def cmd_vmmap(debugger, command, result, _dict):
     '''
         vmmap like in Linux
     '''
-    if platform.system() == 'Linux':
-        # cat /proc/pid/maps
-        proc = get_process()
-        proc_id = proc.GetProcessID()
-
-        with open('/proc/{0}/maps'.format(proc_id), 'r') as f:
-            map_info = f.read()
-            print(map_info)
-
-        return
-
-    if platform.system() != 'Darwin':
-        print('[!] This command only works in macOS')
-        return
-
     addr = evaluate(command)
     if not addr:
         # add color or sth like in this text
-        map_infos = parse_vmmap_info()
+        map_infos = get_memory_maps(refresh=True)
+        if not map_infos:
+            print('[-] Unable to read the memory map of this process')
+            return
 
         for map_info in map_infos:
             display_map_info(map_info)
@@ -2517,30 +2725,89 @@ def cmd_objc(debugger, command, result, _dict):
     if res.Succeeded():
         print(res.GetOutput())
 
-def cmd_pattern_create(debugger, command, result, _dict):
-    pattern_length = parse_number(command) 
+def pattern_parser(prog):
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument("-n", "--order",   type=int, choices=range(1, 9), metavar="{1-8}", help="Length of the unique subsequences, default fits the pattern length")
+    parser.add_argument("-c", "--charset", help="Characters to build the pattern from")
+    return parser
 
+def pattern_charset(args):
+    if args.charset == None:
+        return CYCLIC_CHARSET
+    return args.charset.encode('utf-8')
+
+def cmd_pattern_create(debugger, command, result, _dict):
+    '''Create a cyclic pattern. Use \'pattern_create -h\' for more information.'''
+    parser = pattern_parser("pattern_create")
+    parser.add_argument("length", help="Pattern length")
+    parser.add_argument("-o", "--output", help="Write the pattern to a file")
+    parser.add_argument("-w", "--write",  help="Write the pattern to this address in the target")
+    args = parser.parse_args(command.split())
+
+    pattern_length = parse_number(args.length)
     if pattern_length <= 0:
         print('Invalid pattern_length')
         return
 
-    print(cyclic(pattern_length).decode('utf-8'))
+    charset = pattern_charset(args)
+    try:
+        chunks = cyclic_stream(pattern_length, args.order, charset)
+        if args.output == None and args.write == None:
+            print(b''.join(chunks).decode('utf-8', 'replace'))
+            return
 
-def cmd_pattern_offset(debugger, command, result, _dict):
-    args = command.split(' ')
+        if args.write != None:
+            address = evaluate(args.write)
+            if not address:
+                print(f'Your address "{args.write}" is invalid')
+                return
 
-    if len(args) != 2:
-        print('pattern_offset <value / $register> <length (multiply by 8 for x64 and 4 for x86)>')
-        return
+        # multi-MiB patterns go out chunk by chunk, never whole
+        written = 0
+        output = open(args.output, 'wb') if args.output != None else None
+        try:
+            for chunk in chunks:
+                if output != None:
+                    output.write(chunk)
+                if args.write != None:
+                    if write_mem(address + written, chunk) != len(chunk):
+                        print("[-] error: failed to write pattern at {0}.".format(hex(address + written)))
+                        return
+                written += len(chunk)
+        finally:
+            if output != None:
+                output.close()
+    except ValueError as e:
+        print("[-] error: {0}.".format(e))
+        return
+
+    if args.output != None:
+        print("[+] Wrote {0} pattern bytes to {1}".format(hex(written), args.output))
+    if args.write != None:
+        print("[+] Wrote {0} pattern bytes at {1}".format(hex(written), hex(address)))
+
+def cmd_pattern_offset(debugger, command, result, _dict):
+    '''Find the offset of a value in a cyclic pattern. Use \'pattern_offset -h\' for more information.'''
+    parser = pattern_parser("pattern_offset")
+    parser.add_argument("value", help="Value or $register found in the pattern")
+    parser.add_argument("length", help="Pattern length (multiply by 8 for x64 and 4 for x86)")
+    args = parser.parse_args(command.split())
 
-    value = evaluate(args[0])
+    value = evaluate(args.value)
     if value == 0:
-        print(f'Your value "{args[0]}" is invalid')
+        print(f'Your value "{args.value}" is invalid')
         return
 
-    length = parse_number(args[1])
+    length = parse_number(args.length)
 
-    pos = cyclic_find(value, length)
+    try:
+        pos = cyclic_find(value, length, args.order, pattern_charset(args))
+    except ValueError as e:
+        print("[-] error: {0}.".format(e))
+        return
+    if pos == -1:
+        print('Value {0}{1}{2} not found in pattern'.format(COLORS['YELLOW'], hex(value), COLORS['RESET']))
+        return
     print('Value {0}{1}{2} locate at offset {3}{4}{5}'.format(
         COLORS['YELLOW'], hex(value), COLORS['RESET'], COLORS['YELLOW'], hex(pos), COLORS['RESET'])
     )
@@ -2653,6 +2920,7 @@ def modify_eflags(flag):
         get_frame().reg["rflags"].value = format(eflags, '#x')
     elif is_i386():
         get_frame().reg["eflags"].value = format(eflags, '#x')
+    invalidate_stop_context()
 
 def cmd_cfa(debugger, command, result, dict):
     '''Change adjust flag. Use \'cfa help\' for more information.'''
@@ -2851,7 +3119,11 @@ def cmd_DumpInstructions(debugger, command, result, dict):
 
     global GlobalListOutput
     GlobalListOutput = []
-    
+
+    # code may have been patched without a new stop, recheck it
+    invalidate_instruction_cache()
+    invalidate_dyld_stub_cache()
+
     target = get_target()
     cmd = command.split()
     if len(cmd) == 0 or len(cmd) > 2:
@@ -2875,202 +3147,143 @@ def cmd_DumpInstructions(debugger, command, result, dict):
 
 # return the instruction mnemonic at input address
 def get_mnemonic(target_addr):
-    err = lldb.SBError()
-    target = get_target()
-
-    instruction_list = target.ReadInstructions(lldb.SBAddress(target_addr, target), 1, 'intel')
-    if instruction_list.GetSize() == 0:
+    cur_instruction = get_instruction(target_addr)
+    if not cur_instruction:
         print("[-] error: not enough instructions disassembled.")
         return ""
 
-    cur_instruction = instruction_list.GetInstructionAtIndex(0)
     # much easier to use the mnemonic output instead of disassembling via cmd line and parse
-    mnemonic = cur_instruction.GetMnemonic(target)
-
-    return mnemonic
+    return cur_instruction.mnemonic
 
 # returns the instruction operands
 def get_operands(source_address):
-    err = lldb.SBError()
-    target = get_target()
-    # use current memory address
-    # needs to be this way to workaround SBAddress init bug
-    # src_sbaddr = lldb.SBAddress()
-    # src_sbaddr.load_addr = source_address
-    src_sbaddr = lldb.SBAddress(source_address, target)
-    instruction_list = target.ReadInstructions(src_sbaddr, 1, 'intel')
-    if instruction_list.GetSize() == 0:
+    cur_instruction = get_instruction(source_address)
+    if not cur_instruction:
         print("[-] error: not enough instructions disassembled.")
         return ""    
-    cur_instruction = instruction_list[0]
-    # return cur_instruction.operands
-    return cur_instruction.GetOperands(target)
+    return cur_instruction.operands
 
 # find out the size of an instruction using internal disassembler
 def get_inst_size(target_addr):
-    target = get_target()
-
-    instruction_list = target.ReadInstructions(lldb.SBAddress(target_addr, target), 1, 'intel')
-    if instruction_list.GetSize() == 0:
+    cur_instruction = get_instruction(target_addr)
+    if not cur_instruction:
         print("[-] error: not enough instructions disassembled.")
         return 0
 
-    cur_instruction = instruction_list.GetInstructionAtIndex(0)
     return cur_instruction.size
 
 # the disassembler we use on stop context
 # we can customize output here instead of using the cmdline as before and grabbing its output
-def disassemble(start_address, count):
+def disassemble(start_address, count, ctx=None):
     target = get_target()
     if target == None:
         return
-    # this init will set a file_addr instead of expected load_addr
-    # and so the disassembler output will be referenced to the file address
-    # instead of the current loaded memory address
-    # this is annoying because all RIP references will be related to file addresses
-    file_sbaddr = lldb.SBAddress(start_address, target)
-    # create a SBAddress object with the load_addr set so we can disassemble with
-    # current memory addresses and what is happening right now
-    # we use the empty init and then set the property which is read/write for load_addr
-    # this whole thing seems like a bug?
-    # mem_sbaddr = lldb.SBAddress()
-    # mem_sbaddr.load_addr = start_address
-    # disassemble to get the file and memory version
-    # we could compute this by finding sections etc but this way it seems
-    # much simpler and faster
-    # this seems to be a bug or missing feature because there is no way
-    # to distinguish between the load and file addresses in the disassembler
-    # the reason might be because we can't create a SBAddress that has
-    # load_addr and file_addr set so that the disassembler can distinguish them
-    # somehow when we use file_sbaddr object the SBAddress GetLoadAddress()
-    # retrieves the correct memory address for the instruction while the
-    # SBAddress GetFileAddress() retrives the correct file address
-    # but the branch instructions addresses are the file addresses
-    # bug on SBAddress init implementation???
-    # this also has problems with symbols - the memory version doesn't have them
-    # instructions_mem = target.ReadInstructions(mem_sbaddr, count, "intel")
-    instructions_file = target.ReadInstructions(file_sbaddr, count, "intel")
-    # if instructions_mem.GetSize() != instructions_file.GetSize():
-    #   print("[-] error: instructions arrays sizes are different.")
-    #   return
+    if ctx == None:
+        ctx = get_stop_context()
+    # decoded instructions come from the disassembly cache, only new code is read
+    instructions = get_instructions(start_address, count)
+    if not instructions:
+        return
+
     # find out the biggest instruction lenght and mnemonic length
     # so we can have a uniform output
-    max_size = 0
-    max_mnem_size = 0
-    # for i in instructions_mem:
-    #   if i.size > max_size:
-    #       max_size = i.size
-    #   mnem_len = len(i.mnemonic)
-    #   if mnem_len > max_mnem_size:
-    #       max_mnem_size = mnem_len
-    for instr in instructions_file:
-        if instr.size > max_size:
-            max_size = instr.size
-
-        mnem_len = len(instr.GetMnemonic(target))
-        if mnem_len > max_mnem_size:
-            max_mnem_size = mnem_len
-    
-    current_pc = get_current_pc()
+    max_size = max(inst.size for inst in instructions)
+    max_mnem_size = max(len(inst.mnemonic) for inst in instructions)
+
+    current_pc = ctx.pc if ctx else 0
+    aarch64 = is_aarch64()
     # get info about module if there is a symbol
-    module = file_sbaddr.module
+    module = lldb.SBAddress(start_address, target).module
     #module_name = module.file.GetFilename()
     module_name = module.file.fullpath
 
-    count = 0
-    blockstart_sbaddr = None
-    blockend_sbaddr = None
-    # for mem_inst in instructions_mem:
-    for mem_inst in instructions_file:
-        # get the same instruction but from the file version because we need some info from it
-        file_inst = instructions_file[count]
-        # try to extract the symbol name from this location if it exists
-        # needs to be referenced to file because memory it doesn't work
-        symbol_name = instructions_file[count].addr.GetSymbol().GetName()
+    # symbol (or section) the previous instruction belonged to, instructions
+    # inside the same range reuse its name and load to file address slide
+    range_start = range_end = 0
+    range_symbol = None
+    range_slide = 0
+    block_start = block_end = 0
+
+    for index, inst in enumerate(instructions):
+        # the address the current instruction is loaded at
+        memory_addr = inst.address
+
+        if not (range_start <= memory_addr < range_end):
+            # an SBAddress built from the load address resolves both the symbol and
+            # the address of the instruction in its module, the latter is the address
+            # before ASLR for the main exe, so the current instruction can be found
+            # in a disassembler without having to rebase everything
+            inst_sbaddr = lldb.SBAddress(memory_addr, target)
+            symbol = inst_sbaddr.GetSymbol()
+            section = inst_sbaddr.GetSection()
+            file_address = inst_sbaddr.GetFileAddress()
+
+            range_symbol = symbol.GetName() if symbol.IsValid() else None
+            if symbol.IsValid():
+                range_start = symbol.GetStartAddress().GetLoadAddress(target)
+                range_end = symbol.GetEndAddress().GetLoadAddress(target)
+            elif section.IsValid():
+                range_start = section.GetLoadAddress(target)
+                range_end = range_start + section.GetByteSize()
+            else:
+                range_start = range_end = 0
+
+            # don't trust ranges lldb couldn't map, resolve again on the next instruction
+            if range_end == lldb.LLDB_INVALID_ADDRESS or not (range_start <= memory_addr < range_end):
+                range_start = range_end = 0
+
+            if file_address == lldb.LLDB_INVALID_ADDRESS:
+                range_start = range_end = 0
+                range_slide = None
+            else:
+                range_slide = memory_addr - file_address
+
+        if range_slide == None:
+            file_addr = lldb.LLDB_INVALID_ADDRESS
+        else:
+            file_addr = memory_addr - range_slide
+
         # if there is no symbol just display module where current instruction is
         # also get rid of unnamed symbols since they are useless
-        if not symbol_name or "___lldb_unnamed_symbol" in symbol_name:
-            if count == 0:
+        if not range_symbol or "___lldb_unnamed_symbol" in range_symbol:
+            if index == 0:
                 if CONFIG_ENABLE_COLOR == 1:
                     color(COLOR_SYMBOL_NAME)
                     output("@ {}:".format(module_name) + "\n")
                     color("RESET")
                 else:
                     output("@ {}:".format(module_name) + "\n")            
-        elif symbol_name:
+        elif not block_start or memory_addr < block_start or memory_addr >= block_end:
             # print the first time there is a symbol name and save its interval
             # so we don't print again until there is a different symbol
-            cur_load_addr = file_inst.GetAddress().GetLoadAddress(target)
-
-            blockstart_addr = 0
-            if blockstart_sbaddr:
-                blockstart_addr = blockstart_sbaddr.GetLoadAddress(target)
+            if CONFIG_ENABLE_COLOR == 1:
+                color(COLOR_SYMBOL_NAME)
+                output("{} @ {}:".format(range_symbol, module_name) + "\n")
+                color("RESET")
+            else:
+                output("{} @ {}:".format(range_symbol, module_name) + "\n")
+            block_start = range_start
+            block_end = range_end
 
-            blockend_addr = 0
-            if blockend_sbaddr:
-                blockend_addr = blockend_sbaddr.GetLoadAddress(target)
+        # instruction bytes padded to the biggest instruction
+        bytes_string = inst.data.hex(' ')
+        if inst.size < max_size:
+            bytes_string += "   " * (max_size - inst.size)
 
-            # if not blockstart_sbaddr or (int(file_inst.addr) < int(blockstart_sbaddr)) or (int(file_inst.addr) >= int(blockend_sbaddr)):
-            if not blockstart_addr or (cur_load_addr < blockstart_addr) \
-                                                                or (cur_load_addr >= blockend_addr):
-                if CONFIG_ENABLE_COLOR == 1:
-                    color(COLOR_SYMBOL_NAME)
-                    output("{} @ {}:".format(symbol_name, module_name) + "\n")
-                    color("RESET")
-                else:
-                    output("{} @ {}:".format(symbol_name, module_name) + "\n")
-                blockstart_sbaddr = file_inst.addr.GetSymbol().GetStartAddress()
-                blockend_sbaddr = file_inst.addr.GetSymbol().GetEndAddress()
-        
-        # get the instruction bytes formatted as uint8
-        inst_data = mem_inst.GetData(target).uint8
-        # mnem = mem_inst.mnemonic
-        mnem = mem_inst.GetMnemonic(target)
-        # operands = mem_inst.operands
-        operands = mem_inst.GetOperands(target)
-        bytes_string = ""
-        total_fill = max_size - mem_inst.size
-        total_spaces = mem_inst.size - 1
-        for x in inst_data:
-            bytes_string += "{:02x}".format(x)
-            if total_spaces > 0:
-                bytes_string += " "
-                total_spaces -= 1
-        if total_fill > 0:
-            # we need one more space because the last byte doesn't have space
-            # and if we are smaller than max size we are one space short
-            bytes_string += "  " * total_fill
-            bytes_string += " " * total_fill
-        
-        mnem_len = len(mem_inst.GetMnemonic(target))
-        if mnem_len < max_mnem_size:
-            missing_spaces = max_mnem_size - mnem_len
-            mnem += " " * missing_spaces
+        mnem = inst.mnemonic.ljust(max_mnem_size)
+        operands = inst.operands
 
-        # the address the current instruction is loaded at
-        # we need to extract the address of the instruction and then find its loaded address
-        memory_addr = mem_inst.addr.GetLoadAddress(target)
-        # the address of the instruction in the current module
-        # for main exe it will be the address before ASLR if enabled, otherwise the same as current
-        # for modules it will be the address in the module code, not the address it's loaded at
-        # so we can use this address to quickly get to current instruction in module loaded at a disassembler
-        # without having to rebase everything etc
-        #file_addr = mem_inst.addr.GetFileAddress()
-        file_addr = file_inst.addr.GetFileAddress()
-
-        # fix dyld_shared_arm64 dispatch function to correct symbol name
+        # fix dyld_shared_arm64 dispatch function to correct symbol name, only
+        # direct branches leaving the current symbol can land on a stub
         dyld_resolve_name = ''
         dyld_call_addr = 0
-        if is_aarch64() and instructions_file[count].GetMnemonic(target) in ('bl', 'b'):
-            indirect_addr = get_indirect_flow_target(memory_addr)
-            dyld_call_addr = dyld_arm64_resolve_dispatch(target, indirect_addr)
-            dyld_resolve_name = resolve_symbol_name(dyld_call_addr)
+        if aarch64 and inst.mnemonic in ('bl', 'b') and operands.startswith('0x'):
+            branch_addr = int(operands.split()[0], 16)
+            if not (range_symbol and range_start <= branch_addr < range_end):
+                dyld_call_addr, dyld_resolve_name = resolve_dyld_stub(target, branch_addr)
         
-        # comment = ""
-        # if file_inst.comment != "":
-        #   comment = " ; " + file_inst.comment
         if not dyld_resolve_name:
-            comment = file_inst.GetComment(target)
+            comment = inst.comment
             if comment != '':
                 comment = " ; " + comment
         else:
@@ -3079,18 +3292,17 @@ def disassemble(start_address, count):
         if current_pc == memory_addr:
             # try to retrieve extra information if it's a branch instruction
             # used to resolve indirect branches and try to extract Objective-C selectors
-            if mem_inst.DoesBranch():
+            if inst.does_branch:
 
                 if dyld_call_addr:
                     flow_addr = dyld_call_addr
                 else:
-                    flow_addr = get_indirect_flow_address(mem_inst.GetAddress().GetLoadAddress(target))
+                    flow_addr = get_indirect_flow_address(memory_addr)
                     
                 if flow_addr > 0:
                     flow_module_name = get_module_name(flow_addr)
                     symbol_info = ""
                     # try to solve the symbol for the target address
-                    # target_symbol_name = lldb.SBAddress(flow_addr,target).GetSymbol().GetName()
                     target_symbol_name = resolve_symbol_name(flow_addr)
                     # if there is a symbol append to the string otherwise
                     # it will be empty and have no impact in output
@@ -3099,8 +3311,7 @@ def disassemble(start_address, count):
                     
                     if comment == "":
                         # remove space for instructions without operands
-                        # if mem_inst.operands == "":
-                        if mem_inst.GetOperands(target):
+                        if operands:
                             comment = "; " + symbol_info + hex(flow_addr) + " @ " + flow_module_name
                         else:
                             comment = " ; " + symbol_info + hex(flow_addr) + " @ " + flow_module_name
@@ -3125,10 +3336,8 @@ def disassemble(start_address, count):
                 output("->  0x{:x} (0x{:x}): {}  {}   {}{}".format(memory_addr, file_addr, bytes_string, mnem, operands, comment) + "\n")
         else:
             output("    0x{:x} (0x{:x}): {}  {}   {}{}".format(memory_addr, file_addr, bytes_string, mnem, operands, comment) + "\n")
-
-        count += 1
     
-    return
+    return instructions
 
 # ------------------------------------
 # Commands that use external utilities
@@ -3925,41 +4134,98 @@ def cmd_vm_list_snapshot(debugger, command, result, dict):
 
 # ------------------------------------------------------------------------------------------- #
 
-def display_stack():
+# ---------------------------
+# Incremental context panes
+# ---------------------------
+
+# the stack and data panes display 4 lines of 16 bytes
+CONTEXT_WINDOW_SIZE = 0x40
+
+class ContextPane(object):
+    '''
+        Output of one context pane and the state it was rendered from, the pane
+        is only rendered again when the state differs from the previous stop.
+        Only the formatting is cached: memory backed panes still read their
+        window on every stop, through the per-render page cache, to build
+        their state.
+    '''
+    def __init__(self):
+        self.state = None
+        self.output = []
+
+    def render(self, state, renderer, *args):
+        # a None state (e.g. unreadable memory) is never reused
+        if state == None or state != self.state:
+            saved_output = render_output.buffer
+            render_output.buffer = []
+            try:
+                renderer(*args)
+            finally:
+                self.output = render_output.buffer
+                render_output.buffer = saved_output
+            self.state = state
+
+        render_output.buffer.extend(self.output)
+
+stack_pane = ContextPane()
+data_pane = ContextPane()
+# (process uid, start address, instruction addresses) of the displayed code window
+code_window = None
+
+def read_context_window(ctx, addr):
+    '''Bytes shown by the stack and data panes, None if they can't be read'''
+    if addr == 0:
+        return None
+    # windows next to a guard page show their readable bytes, zero filled
+    membuff, mask = read_mem_masked(addr, CONTEXT_WINDOW_SIZE, ctx.process)
+    if b'\x01' not in mask:
+        return None
+    return membuff
+
+def context_window_state(ctx, addr, membuff):
+    '''Pane state of a memory window, its address and a crc32 of its bytes'''
+    if membuff == None:
+        return None
+    return (addr, ctx.pointer_size, CONFIG_ENABLE_COLOR, zlib.crc32(membuff))
+
+def display_stack(ctx, membuff=None):
     '''Hex dump current stack pointer'''
-    stack_addr = get_current_sp()
+    stack_addr = ctx.sp
     if stack_addr == 0:
         return
-    err = lldb.SBError()
-    membuff = get_process().ReadMemory(stack_addr, 0x100, err)
-    if err.Success() == False:
+    if membuff == None:
+        membuff = read_context_window(ctx, stack_addr)
+    if membuff == None:
         print("[-] error: Failed to read memory at 0x{:x}.".format(stack_addr))
         return
-    if len(membuff) == 0:
-        print("[-] error: not enough bytes read.")
-        return
 
-    output(hexdump(stack_addr, membuff, " ", 16, 4))
+    output(hexdump(stack_addr, membuff, " ", 16, 4, ctx.pointer_size))
 
-def display_data():
+def display_data(ctx, membuff=None):
     '''Hex dump current data window pointer'''
     data_addr = DATA_WINDOW_ADDRESS
     if data_addr == 0:
         return
-    err = lldb.SBError()
-    membuff = get_process().ReadMemory(data_addr, 0x100, err)
-    if err.Success() == False:
+    if membuff == None:
+        membuff = read_context_window(ctx, data_addr)
+    if membuff == None:
         print("[-] error: Failed to read memory at 0x{:x}.".format(data_addr))
         return
-    if len(membuff) == 0:
-        print("[-] error: not enough bytes read.")
-        return
 
-    output(hexdump(data_addr, membuff, " ", 16, 4))
+    output(hexdump(data_addr, membuff, " ", 16, 4, ctx.pointer_size))
+
+def get_code_window_start(ctx):
+    '''Keep the previous code window while PC moves inside it, shift it to PC otherwise'''
+    if code_window:
+        process_uid, start, addresses = code_window
+        # the last line is kept as lookahead, reaching it shifts the window
+        if process_uid == ctx.process_uid and ctx.pc in addresses[:-1]:
+            return start
+
+    return ctx.pc
 
 # workaround for lldb bug regarding RIP addressing outside main executable
 def get_rip_relative_addr(source_address):
-    err = lldb.SBError()
     inst_size = get_inst_size(source_address)
     if inst_size <= 1:
         print("[-] error: instruction size too small.")
@@ -3967,8 +4233,8 @@ def get_rip_relative_addr(source_address):
     # XXX: problem because it's not just 2 and 5 bytes
     # 0x7fff53fa2180 (0x1180): 0f 85 84 01 00 00     jne    0x7fff53fa230a ; stack_not_16_byte_aligned_error
 
-    offset_bytes = get_process().ReadMemory(source_address+1, inst_size-1, err)
-    if err.Success() == False:
+    offset_bytes = read_mem(source_address+1, inst_size-1)
+    if not offset_bytes:
         print("[-] error: Failed to read memory at 0x{:x}.".format(source_address))
         return 0
     if inst_size == 2:
@@ -3979,9 +4245,20 @@ def get_rip_relative_addr(source_address):
     #output("source {:x} rip call offset {:x} {:x}\n".format(source_address, data[0], rip_call_addr))
     return rip_call_addr
 
+# read a register value for flow resolution from the register file of this stop,
+# only registers outside the general set go through the expression parser
+def get_flow_register(reg_name):
+    registers = get_gp_registers()
+    if registers and reg_name in registers:
+        return registers[reg_name]
+
+    value = get_frame().EvaluateExpression("$" + reg_name)
+    if value.IsValid() == False or value.GetValue() == None:
+        return None
+    return int(value.GetValue(), 10)
+
 # XXX: instead of reading memory we can dereference right away in the evaluation
 def get_indirect_flow_target(source_address):
-    err = lldb.SBError()
     operand = get_operands(source_address)
     operand = operand.lower()
     #output("Operand: {}\n".format(operand))
@@ -3991,32 +4268,29 @@ def get_indirect_flow_target(source_address):
         deref_addr = 0
         # first we need to find the address to dereference
         if '+' in operand:
-            x = re.search('\[([a-z0-9]{2,3} \+ 0x[0-9a-z]+)\]', operand)
+            x = re.search('\[([a-z0-9]{2,3}) \+ (0x[0-9a-z]+)\]', operand)
             if x == None:
                 return 0
-            value = get_frame().EvaluateExpression("$" + x.group(1))
-            if value.IsValid() == False:
+            reg_value = get_flow_register(x.group(1))
+            if reg_value == None:
                 return 0
-            deref_addr = int(value.GetValue(), 10)
+            deref_addr = reg_value + int(x.group(2), 16)
             if "rip" in operand:
                 deref_addr = deref_addr + get_inst_size(source_address)
         else:
             x = re.search('\[([a-z0-9]{2,3})\]', operand)
             if x == None:
                 return 0
-            value = get_frame().EvaluateExpression("$" + x.group(1))
-            if value.IsValid() == False:
+            deref_addr = get_flow_register(x.group(1))
+            if deref_addr == None:
                 return 0
-            deref_addr = int(value.GetValue(), 10)
         # now we can dereference and find the call target
         if get_pointer_size() == 4:
-            call_target_addr = get_process().ReadUnsignedFromMemory(deref_addr, 4, err)
+            call_target_addr = int.from_bytes(read_mem(deref_addr, 4), 'little')
             return call_target_addr
         elif get_pointer_size() == 8:
-            call_target_addr = get_process().ReadUnsignedFromMemory(deref_addr, 8, err)
+            call_target_addr = int.from_bytes(read_mem(deref_addr, 8), 'little')
             return call_target_addr
-        if err.Success() == False:
-            return 0
         return 0        
     # calls into a register included x86_64 and aarch64
     elif operand.startswith('r') or operand.startswith('e') or operand.startswith('x') or \
@@ -4027,10 +4301,10 @@ def get_indirect_flow_target(source_address):
         #   return 0
 
         #output("Result {}\n".format(x.group(1)))
-        value = get_frame().EvaluateExpression("$" + operand)
-        if value.IsValid() == False:
+        reg_value = get_flow_register(operand)
+        if reg_value == None:
             return 0
-        return int(value.GetValue(), 10)
+        return reg_value
     # RIP relative calls
     elif operand.startswith('0x'):
         #output("direct call\n")
@@ -4043,15 +4317,14 @@ def get_indirect_flow_target(source_address):
     return 0
 
 def get_ret_address():
-    err = lldb.SBError()
     stack_addr = get_current_sp()
     if stack_addr == 0:
         return -1
-    ret_addr = get_process().ReadPointerFromMemory(stack_addr, err)
-    if err.Success() == False:
+    membuff = read_mem(stack_addr, get_pointer_size())
+    if not membuff:
         print("[-] error: Failed to read memory at 0x{:x}.".format(stack_addr))
         return -1
-    return ret_addr
+    return int.from_bytes(membuff, 'little')
 
 def is_sending_objc_msg():
     err = lldb.SBError()
@@ -4062,8 +4335,6 @@ def is_sending_objc_msg():
 
 # XXX: x64 only
 def display_objc():
-    err = lldb.SBError()
-
     options = lldb.SBExpressionOptions()
     options.SetLanguage(lldb.eLanguageTypeObjC)
     options.SetTrapExceptions(False)
@@ -4081,20 +4352,18 @@ def display_objc():
     else:
         return
 
-    membuff = get_process().ReadMemory(selector_addr, 0x100, err)
-    selector = membuff.split(b'\x00')
-    if len(selector) != 0:
-        color("RED")
-        output('Class: ')
-        color("RESET")
-        output(className)
-        color("RED")
-        output(' Selector: ')
-        color("RESET")
-        output(selector[0].decode('utf-8'))
+    selector = read_str(selector_addr, 0x100)
+    color("RED")
+    output('Class: ')
+    color("RESET")
+    output(className)
+    color("RED")
+    output(' Selector: ')
+    color("RESET")
+    output(selector.decode('utf-8', 'replace'))
 
-def display_indirect_flow():
-    pc_addr = get_current_pc()
+def display_indirect_flow(ctx):
+    pc_addr = ctx.pc
     mnemonic = get_mnemonic(pc_addr)
 
     if ("ret" in mnemonic):
@@ -4126,25 +4395,19 @@ def display_indirect_flow():
 
 # find out the target address of ret, and indirect call and jmp
 def get_indirect_flow_address(src_addr):
-    target = get_target()
-    instruction_list = target.ReadInstructions(lldb.SBAddress(src_addr, target), 1, 'intel')
-    if instruction_list.GetSize() == 0:
+    cur_instruction = get_instruction(src_addr)
+    if not cur_instruction:
         print("[-] error: not enough instructions disassembled.")
         return -1
 
-    cur_instruction = instruction_list.GetInstructionAtIndex(0)
-    if not cur_instruction.DoesBranch():
+    if not cur_instruction.does_branch:
         return -1
 
-    mnemonic = cur_instruction.GetMnemonic(target)
+    mnemonic = cur_instruction.mnemonic
     # if "ret" in cur_instruction.mnemonic:
     if 'ret' in mnemonic:
         if is_aarch64():
-            ret_addr = get_gp_register('x30')
-            if ret_addr == 0:
-                ret_addr = get_gp_register('lr')
-            
-            return ret_addr
+            return get_gp_register('lr')
 
         ret_addr = get_ret_address()
         return ret_addr
@@ -4153,7 +4416,7 @@ def get_indirect_flow_address(src_addr):
     if mnemonic in ('call', 'jmp') or mnemonic in ('bl', 'br', 'b', 'blr'):
         # don't care about RIP relative jumps
         # if cur_instruction.operands.startswith('0x'):
-        if cur_instruction.GetOperands(target).startswith('0x'):
+        if cur_instruction.operands.startswith('0x'):
             return -1
         indirect_addr = get_indirect_flow_target(src_addr)
         return indirect_addr
@@ -4200,11 +4463,9 @@ def get_objectivec_selector_at(call_addr):
             else:
                 selector_addr = get_gp_register("x1")
             
-            err = lldb.SBError()
-            membuf = get_process().ReadMemory(selector_addr, 0x100, err)
-            selector = membuf.split(b'\00')
-            if len(selector) != 0:
-                return "[" + className + " " + selector[0].decode('utf-8') + "]"
+            selector = read_str(selector_addr, 0x100)
+            if selector:
+                return "[" + className + " " + selector.decode('utf-8', 'replace') + "]"
             else:
                 return "[" + className + "]"
         else:
@@ -4227,22 +4488,13 @@ def get_objectivec_selector(src_addr):
 # The heart of lldbinit - when lldb stop this is where we land 
 # ------------------------------------------------------------
 
-def print_cpu_registers(register_names):
-    registers = get_gp_registers()
+def print_cpu_registers(ctx, register_names):
+    registers = ctx.registers
     break_flag = False
     reg_flag_val = -1
 
     for i, register_name in enumerate(register_names):
-        try:
-            reg_val = registers[register_name]
-        except KeyError:
-            if is_aarch64():
-                if register_name == 'x29':
-                    register_name = 'fp'
-                    reg_val = registers['fp']
-                elif register_name == 'x30':
-                    register_name == 'lr'
-                    reg_val = registers['lr']
+        reg_val = registers.get(register_name, 0)
 
         if register_name in flag_regs:
             output("  ")
@@ -4296,9 +4548,9 @@ def print_cpu_registers(register_names):
             output('\n')
 
     if is_x64() or is_i386():
-        dump_jumpx86(reg_flag_val)
+        dump_jumpx86(ctx, reg_flag_val)
     elif is_aarch64():
-        dump_jump_arm64(reg_flag_val)
+        dump_jump_arm64(ctx, reg_flag_val)
     
     output("\n")
         
@@ -4316,19 +4568,16 @@ def dump_eflags(eflags):
             output(flag[0].lower() + " ")
 
 # function to dump the conditional jumps results
-def dump_jumpx86(eflags):
+def dump_jumpx86(ctx, eflags):
     # masks and flags from https://github.com/ant4g0nist/lisa.py
     masks = { "CF":0, "PF":2, "AF":4, "ZF":6, "SF":7, "TF":8, "IF":9, "DF":10, "OF":11 }
     flags = { key: bool(eflags & (1 << value)) for key, value in masks.items() }
 
-    if is_i386():
-        pc_addr = get_gp_register("eip")
-    elif is_x64():
-        pc_addr = get_gp_register("rip")
-    else:
+    if not is_i386() and not is_x64():
         print("[-] dump_jumpx86() error: wrong architecture.")
         return
 
+    pc_addr = ctx.pc
     mnemonic = get_mnemonic(pc_addr)
     color("RED")
     output_string=""
@@ -4363,9 +4612,9 @@ def dump_jumpx86(eflags):
     ## opcode 0xE3: JCXZ, JECXZ, JRCXZ (jump if CX=0 or ECX=0 or RCX=0)
     # XXX: we just need cx output...
     elif "jcxz" == mnemonic or "jecxz" == mnemonic or "jrcxz" == mnemonic:
-        rcx = get_gp_register("rcx")
-        ecx = get_gp_register("ecx")
-        cx = get_gp_register("cx")
+        rcx = ctx.registers.get("rcx", 0)
+        ecx = ctx.registers.get("ecx", 0)
+        cx = ctx.registers.get("cx", 0)
         if ecx == 0 or cx == 0 or rcx == 0:
             output_string="Jump is taken (cx = 0 or ecx = 0 or rcx = 0)"
         else:
@@ -4476,12 +4725,12 @@ def dump_cpsr(cpsr):
         else:
             output(flag.lower() + " ")
 
-def dump_jump_arm64(cpsr):
+def dump_jump_arm64(ctx, cpsr):
     masks = { 'N': 31, 'Z':30, 'C':29, 'V': 28, 'Q':27, 'J':24, 'E':9, 'A':8, 'I':7, 'F':6, 'T':5}
     flags = { key: bool(cpsr & (1 << value)) for key, value in masks.items() }
 
     if is_aarch64():
-        pc_addr = get_gp_register("pc")
+        pc_addr = ctx.pc
     else:
         print("[-] dump_jump_arm64() error: wrong architecture.")
         return
@@ -4553,22 +4802,106 @@ def dump_jump_arm64(cpsr):
     
     color("RESET")
 
-def print_registers():
-    if is_i386(): 
-        # reg32()
-        register_format = x86_registers
-    elif is_x64():
-        # reg64()
-        register_format = x86_64_registers
-    elif is_arm():
-        # regarm()
-        register_format = arm_32_registers
-    elif is_aarch64():
-        register_format = aarch64_registers
-    else:
+def print_registers(ctx):
+    register_format = ctx.arch_info.registers
+    if not register_format:
         raise OSError('Unsupported Architecture')
 
-    print_cpu_registers(register_format)
+    print_cpu_registers(ctx, register_format)
+
+# listener on the state changes of the current process, used to wait for a stop
+stop_listener = None
+stop_listener_uid = None
+
+def wait_for_stop(process, timeout=1):
+    '''Wait on process events until a thread reports why the process stopped'''
+    global stop_listener
+    global stop_listener_uid
+
+    if stop_listener_uid != process.GetUniqueID():
+        stop_listener = lldb.SBListener('lldbinit.stop_hook')
+        process.GetBroadcaster().AddListener(stop_listener, lldb.SBProcess.eBroadcastBitStateChanged)
+        stop_listener_uid = process.GetUniqueID()
+
+    event = lldb.SBEvent()
+    deadline = time.time() + timeout
+    while True:
+        # events already queued are older than the state we are about to read
+        while stop_listener.GetNextEvent(event):
+            pass
+
+        state = process.GetState()
+        if state == lldb.eStateStopped:
+            for thread in process:
+                if thread.GetStopReason() != lldb.eStopReasonNone and thread.GetStopReason() != lldb.eStopReasonInvalid:
+                    return thread
+            return None
+
+        # the hook can run before the public state caught up, anything else isn't a stop
+        if state != lldb.eStateRunning and state != lldb.eStateStepping:
+            return None
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        stop_listener.WaitForEvent(max(1, int(remaining)), event)
+
+class ContextRenderer(object):
+    '''
+        Renders the context on a worker thread. Each stop bumps the generation,
+        a render whose stop was superseded before it finished is dropped.
+    '''
+    def __init__(self):
+        self.generation = 0
+        self.pending = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='lldbinit.context')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, process):
+        with self.condition:
+            self.generation += 1
+            self.pending = (self.generation, process, process.GetStopID())
+            self.condition.notify()
+
+    def is_stale(self, generation, process, stop_id):
+        return generation != self.generation or process.GetStopID() != stop_id or \
+            process.GetState() != lldb.eStateStopped
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending == None:
+                    self.condition.wait()
+                generation, process, stop_id = self.pending
+                self.pending = None
+
+            if self.is_stale(generation, process, stop_id):
+                continue
+
+            try:
+                data = render_context()
+            except Exception as e:
+                # the process may resume under us, only report it for the latest stop
+                if not self.is_stale(generation, process, stop_id):
+                    print("[-] error: context rendering failed: {0}".format(e))
+                continue
+
+            if data == None or self.is_stale(generation, process, stop_id):
+                continue
+            print(data)
+            sys.stdout.flush()
+
+context_renderer = None
+# the panes share their cached state, one render at a time
+context_lock = threading.Lock()
+
+def get_context_renderer():
+    global context_renderer
+    if context_renderer == None:
+        context_renderer = ContextRenderer()
+    return context_renderer
 
 def HandleHookStopOnTarget(debugger, command, result, dict):
     '''Display current code context.'''
@@ -4576,9 +4909,6 @@ def HandleHookStopOnTarget(debugger, command, result, dict):
     if os.getenv('PATH').startswith('/Applications/Xcode.app'):
         return
     
-    global GlobalListOutput
-    global CONFIG_DISPLAY_STACK_WINDOW
-    global CONFIG_DISPLAY_FLOW_WINDOW
     global CONFIG_NO_CTX
 
     if CONFIG_NO_CTX:
@@ -4586,107 +4916,130 @@ def HandleHookStopOnTarget(debugger, command, result, dict):
 
     debugger.SetAsync(True)
 
+    process = get_process()
     # when we start the thread is still not valid and get_frame() will always generate a warning
     # this way we avoid displaying it in this particular case
-    if get_process().GetNumThreads() == 1:
-        thread = get_process().GetThreadAtIndex(0)
+    if process.GetNumThreads() == 1:
+        thread = process.GetThreadAtIndex(0)
         if thread.IsValid() == False:
             return
 
-    # frame = get_frame()
-    # frame = get_frame_at_selected_thread()
-    # if type(frame) == type(None): 
-    #   return
-            
-    # thread= frame.GetThread()
-    while True:
-        frame = get_frame()
-        if type(frame) == type(None): 
-            return
+    # instead of polling the stop reason we sleep on the process events
+    if not wait_for_stop(process):
+        print("[-] warning: timed out waiting for process stop.")
+        return
 
-        thread = frame.GetThread()
-        if thread.GetStopReason() == lldb.eStopReasonNone or thread.GetStopReason() == lldb.eStopReasonInvalid:
-        # if thread.GetStopReason() == lldb.eStopReasonInvalid:
-            time.sleep(0.001)
-        else:
-            break
-        
-    GlobalListOutput = []
-    
-    arch = get_arch()
+    if CONFIG_ASYNC_CONTEXT == 1:
+        get_context_renderer().submit(process)
+        return 0
+
+    data = render_context()
+    if data == None:
+        return
+    result.PutCString(data)
+    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
+    return 0
+
+def render_context():
+    '''Render all the context panes of the current stop, None on error'''
+    with context_lock:
+        # rendered apart from GlobalListOutput, a command may be using it meanwhile
+        render_output.buffer = []
+        stop_render.active = True
+        try:
+            return render_context_panes()
+        finally:
+            render_output.buffer = None
+            stop_render.active = False
+
+def render_context_panes():
+    global CONFIG_DISPLAY_STACK_WINDOW
+    global CONFIG_DISPLAY_FLOW_WINDOW
+    global code_window
+
+    # everything the panes need from this stop is captured once here
+    ctx = get_stop_context()
+    if not ctx:
+        return
+
+    arch = ctx.arch
     if not is_i386() and not is_x64() and not is_arm() and not is_aarch64():
         #this is for ARM probably in the future... when I will need it...
         print("[-] error: Unknown architecture : " + arch)
         return
 
+    if ctx.pointer_size == 4:
+        separator = "---------------------------------------------------------------------------------"
+    else:
+        separator = "-----------------------------------------------------------------------------------------------------------------------"
+
     color(COLOR_SEPARATOR)
-    if is_i386() or is_arm():
-        output("---------------------------------------------------------------------------------")
-    elif is_x64() or is_aarch64():
-        output("-----------------------------------------------------------------------------------------------------------------------")
-            
+    output(separator)
     color("BOLD")
     output("[regs]\n")
     color("RESET")
-    print_registers()
+    print_registers(ctx)
 
     if CONFIG_DISPLAY_STACK_WINDOW == 1:
         color(COLOR_SEPARATOR)
-        if is_i386() or is_arm():
-            output("--------------------------------------------------------------------------------")
-        elif is_x64() or is_aarch64():
-            output("----------------------------------------------------------------------------------------------------------------------")
+        output(separator[:-1])
         color("BOLD")
         output("[stack]\n")
         color("RESET")
-        display_stack()
+        stack_window = read_context_window(ctx, ctx.sp)
+        stack_pane.render(context_window_state(ctx, ctx.sp, stack_window), display_stack, ctx, stack_window)
         output("\n")
 
     if CONFIG_DISPLAY_DATA_WINDOW == 1:
         color(COLOR_SEPARATOR)
-        if is_i386() or is_arm():
-            output("---------------------------------------------------------------------------------")
-        elif is_x64() or is_aarch64():
-            output("-----------------------------------------------------------------------------------------------------------------------")
+        output(separator)
         color("BOLD")
         output("[data]\n")
         color("RESET")
-        display_data()
+        data_window = read_context_window(ctx, DATA_WINDOW_ADDRESS)
+        data_pane.render(context_window_state(ctx, DATA_WINDOW_ADDRESS, data_window), display_data, ctx, data_window)
         output("\n")
 
     if CONFIG_DISPLAY_FLOW_WINDOW == 1 and is_x64() and is_aarch64():
         color(COLOR_SEPARATOR)
-        if is_i386() or is_arm():
-            output("---------------------------------------------------------------------------------")
-        elif is_x64() or is_aarch64():
-            output("-----------------------------------------------------------------------------------------------------------------------")
+        output(separator)
         color("BOLD")
         output("[flow]\n")
         color("RESET")
-        display_indirect_flow()
+        display_indirect_flow(ctx)
 
     color(COLOR_SEPARATOR)
-    if is_i386() or is_arm():
-        output("---------------------------------------------------------------------------------")
-    elif is_x64() or is_aarch64():
-        output("-----------------------------------------------------------------------------------------------------------------------")
+    output(separator)
     color("BOLD")
     output("[code]\n")
     color("RESET")
             
-    # disassemble and add its contents to output inside
-    disassemble(get_current_pc(), CONFIG_DISASSEMBLY_LINE_COUNT)
+    # disassemble and add its contents to output inside, the window only
+    # shifts once PC leaves it so stepping reuses the decoded instructions
+    code_start = get_code_window_start(ctx)
+    instructions = disassemble(code_start, CONFIG_DISASSEMBLY_LINE_COUNT, ctx)
+    if instructions:
+        code_window = (ctx.process_uid, code_start, [inst.address for inst in instructions])
+    else:
+        code_window = None
         
     color(COLOR_SEPARATOR)
-    if get_pointer_size() == 4: #is_i386() or is_arm():
+    if ctx.pointer_size == 4:
         output("---------------------------------------------------------------------------------------")
-    elif get_pointer_size() == 8: #is_x64():
+    else:
         output("-----------------------------------------------------------------------------------------------------------------------------")
     color("RESET")
     
     # XXX: do we really need to output all data into the array and then print it in a single go? faster to just print directly?
     # was it done this way because previously disassembly was capturing the output and modifying it?
-    data = "".join(GlobalListOutput)
-    result.PutCString(data)
-    result.SetStatus(lldb.eReturnStatusSuccessFinishResult)
-    return 0
+    return "".join(render_output.buffer)
+
+def cmd_context(debugger, command, result, dict):
+    '''Display current code context.'''
+    # registers, memory and code may have been written since the stop (memory write,
+    # other scripts), none of which changes the stop id, so always take a fresh snapshot
+    invalidate_stop_context()
+    invalidate_memory_cache()
+    invalidate_instruction_cache()
+    invalidate_dyld_stub_cache()
+    return HandleHookStopOnTarget(debugger, command, result, dict)
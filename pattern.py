@@ -0,0 +1,176 @@
+'''
+Cyclic pattern functions to find offset on memory
+'''
+from struct import error
+from utils import p32, p64
+
+# ----------------------------------------------------------
+# Cyclic algorithm to find offset on memory
+# ----------------------------------------------------------
+
+# upper, lower and digit charsets interleaved into the pattern alphabet
+CYCLIC_CHARSETS = [b'ABCDEFGHIJKLMNOPQRSTUVWXYZ', b'%$-;abcdefghijklmopqrtuvwxyz', b'sn()0123456789']
+# every pattern up to len(CYCLIC_CHARSET)**3 bytes keeps the historical n = 3
+CYCLIC_MIN_N = 3
+# patterns longer than this are searched with bytes.find instead of an n-gram index
+CYCLIC_INDEX_MAX = 0x40000
+CYCLIC_CACHE_MAX = 4
+
+# (charset, n, length) -> (sequence, {n-gram: offset} or None)
+cyclic_cache = {}
+
+def mix_charsets(charsets):
+	mixed_charset = mixed = b''
+	k = 0
+	while True:
+		for i in range(0, len(charsets)): mixed += charsets[i][k:k+1]
+		if not mixed: break
+		mixed_charset += mixed
+		mixed = b''
+		k+=1
+	return mixed_charset
+
+CYCLIC_CHARSET = mix_charsets(CYCLIC_CHARSETS)
+
+def de_bruijn_blocks(k, n):
+	# yield the de Bruijn sequence over range(k) as blocks of alphabet indexes,
+	# walking the Lyndon words iteratively (FKM algorithm)
+	word = [-1]
+	while word:
+		word[-1] += 1
+		p = len(word)
+		if p == n:
+			# the next words only differ in their last symbol, emit all of them
+			# at once by striding the symbols into copies of the prefix
+			first = word[-1]
+			block = bytearray(bytes(word)) * (k - first)
+			block[n - 1::n] = bytes(range(first, k))
+			yield block
+			word.pop()
+		else:
+			if n % p == 0:
+				yield bytes(word)
+			while len(word) < n:
+				word.append(word[-p])
+
+		while word and word[-1] == k - 1:
+			word.pop()
+
+def de_bruijn_stream(charset, n = 4, maxlen = 0x10000, chunk_size = 0x100000):
+	# yield the de Bruijn sequence over charset in chunks of chunk_size bytes
+	k = len(charset)
+	if not k or k > 256 or len(set(charset)) != k:
+		raise ValueError('charset must be 1 to 256 unique bytes')
+	if n < 1:
+		raise ValueError('n must be positive')
+	if maxlen is None:
+		maxlen = k ** n
+
+	table = bytes(charset) + bytes(256 - k)
+	chunk = bytearray(min(chunk_size, maxlen))
+	filled = 0
+	remaining = maxlen
+	for block in de_bruijn_blocks(k, n):
+		pos = 0
+		while pos < len(block) and remaining:
+			size = min(len(block) - pos, len(chunk) - filled, remaining)
+			chunk[filled:filled + size] = block[pos:pos + size]
+			filled += size
+			pos += size
+			remaining -= size
+			if filled == len(chunk):
+				yield bytes(chunk.translate(table))
+				filled = 0
+		if not remaining:
+			break
+
+	if filled:
+		yield bytes(chunk[:filled].translate(table))
+
+def de_bruijn(charset , n = 4, maxlen = 0x10000):
+	# this code base on https://github.com/Gallopsled/pwntools/blob/master/pwnlib/util/cyclic.py
+	"""de_bruijn(charset = string.ascii_lowercase, n = 4) -> bytearray
+
+	Sequence of unique substrings of length `n` over the given `charset`, built
+	without recursion so it can produce multi-MiB patterns. The output matches
+	the recursive FKM version byte for byte.
+
+	Arguments:
+	  charset: bytes to generate the sequence over.
+	  n(int): The length of subsequences that should be unique.
+	  maxlen(int): truncate the sequence, None for all ``len(charset)**n`` bytes.
+	"""
+	if maxlen is None:
+		maxlen = len(charset) ** n
+	sequence = bytearray(maxlen)
+	pos = 0
+	for chunk in de_bruijn_stream(charset, n, maxlen):
+		sequence[pos:pos + len(chunk)] = chunk
+		pos += len(chunk)
+	del sequence[pos:]
+	return sequence
+
+def cyclic_order(length, charset = CYCLIC_CHARSET):
+	# smallest n whose de Bruijn sequence is long enough for length
+	n = CYCLIC_MIN_N
+	if length is not None:
+		while len(charset) > 1 and len(charset) ** n < length:
+			n += 1
+	return n
+
+def cyclic_pattern(length = None, n = None, charset = CYCLIC_CHARSET):
+	# return cached (sequence, n-gram index, n) of a cyclic pattern
+	if n is None:
+		n = cyclic_order(length, charset)
+
+	key = (charset, n, length)
+	entry = cyclic_cache.get(key)
+	if entry is None:
+		sequence = bytes(de_bruijn(charset, n, length))
+		index = None
+		if len(sequence) <= CYCLIC_INDEX_MAX:
+			# each n-gram occurs once, keep its first offset like a forward scan
+			index = {}
+			for pos in range(len(sequence) - n, -1, -1):
+				index[sequence[pos:pos + n]] = pos
+
+		if len(cyclic_cache) >= CYCLIC_CACHE_MAX:
+			cyclic_cache.clear()
+		entry = cyclic_cache[key] = (sequence, index, n)
+	return entry
+
+# generate a cyclic string
+def cyclic(length = None, n = None, charset = CYCLIC_CHARSET):
+	return cyclic_pattern(length, n, charset)[0]
+
+def cyclic_stream(length, n = None, charset = CYCLIC_CHARSET, chunk_size = 0x100000):
+	# yield a cyclic string in chunks without keeping it around
+	if n is None:
+		n = cyclic_order(length, charset)
+	return de_bruijn_stream(charset, n, length, chunk_size)
+
+def cyclic_find(subseq, length = 0x10000, n = None, charset = CYCLIC_CHARSET):
+	# return position of subseq in cyclic(length)
+	# if it doens't find then return -1
+	if isinstance(subseq, int): # subseq might be a number or hex value
+		try:
+			subseq = p32(subseq)
+		except error: # struct.error
+			try:
+				subseq = p64(subseq)
+			except error: # struct.error
+				return -1
+
+	if not isinstance(subseq, (bytes, bytearray)):
+		return -1
+	subseq = bytes(subseq)
+
+	sequence, index, n = cyclic_pattern(length, n, charset)
+	if index is None or len(subseq) < n:
+		return sequence.find(subseq)
+
+	# the leading n-gram pins the only place subseq can start
+	pos = index.get(subseq[:n], -1)
+	if pos == -1 or sequence[pos:pos + len(subseq)] != subseq:
+		return -1
+	return pos
@@ -8,7 +8,14 @@ from subprocess import Popen, PIPE, check_call, CalledProcessError
 from pathlib import Path
 from struct import *
 import platform
+import json
 import time
+import zlib
+from array import array
+from bisect import bisect_right
+from heapq import heapify, heappop, heappush, heapreplace
+from collections import OrderedDict
+import threading
 
 # default colors - modify as you wish
 COLOR_REGVAL           = "WHITE"
@@ -63,9 +70,7 @@ def get_color_status(addr):
 	elif xinfo['section_name'] == '__DATA':
 		return "MAGENTA"
 
-	error = lldb.SBError()
-	process.ReadMemory(addr, 1, error)
-	if error.Success():
+	if read_memory(process, addr, 1) != None:
 		# memory is readable
 		return "CYAN"
 
@@ -82,7 +87,7 @@ def get_selected_frame(debugger):
 	return frame
 
 def get_arch():
-	return lldb.debugger.GetSelectedTarget().triple.split('-')[0]
+	return get_arch_info().arch
 
 def get_process():
 	'''
@@ -158,25 +163,96 @@ def evaluate(command):
 		
 		return try_convert_str_to_int(value.GetValue())
 
+# ----------------------------------------------------------
+# Architecture detection
+# ----------------------------------------------------------
+
+# register layouts used by the context registers window
+x86_registers = [
+	"eax", "ebx", "ebp", "esp", "eflags", "edi", "esi", "edx", "ecx", "eip",
+	"cs", "ds", "es", "gs", "fs", "ss"
+]
+
+x86_64_registers = [
+	"rax", "rbx", "rbp", "rsp", "rflags", "rdi", "rsi", "rdx", "rcx", "rip",
+	"r8", "r9", "r10", "r11", "r12", "r13", "r14", "r15", "cs", "gs", "fs"
+]
+
+arm_32_registers = [
+	"r0", "r1", "r2", "r3", "cpsr", "r4", "r5", "r6", "r7", "r8",
+	"r9", "r10", "r11", "r12", "sp", "lr", "pc"
+]
+
+aarch64_registers = [
+	'x0', 'x1', 'x2', 'x3', 'cpsr',
+	'x4', 'x5', 'x6', 'x7', 
+	'x8', 'x9', 'x10', 'x11',
+	'x12', 'x13', 'x14', 'x15', 
+	'x16', 'x17', 'x18', 'x19', 
+	'x20', 'x21', 'x22', 'x23', 
+	'x24', 'x25', 'x26', 'x27', 
+	'x28', 'x29', 'x30', 'sp', 'pc', 'fpcr', 'fpsr'
+]
+
+# descriptor of the selected target, recomputed when the target or its process changes
+arch_info_cache = None
+
+class ArchInfo(object):
+	def __init__(self, target):
+		self.target       = target
+		self.process_uid  = target.GetProcess().GetUniqueID()
+		self.triple       = target.triple or ''
+		self.arch         = self.triple.split('-')[0]
+		self.pointer_size = target.GetAddressByteSize()
+
+		self.is_i386    = self.arch[0:1] == "i"
+		self.is_x64     = self.arch.startswith("x86_64")
+		self.is_arm     = self.arch == "armv7"
+		self.is_aarch64 = self.arch == 'aarch64' or self.arch.startswith('arm64')
+
+		if self.is_i386:
+			self.sp_reg, self.pc_reg, self.flags_reg = 'esp', 'eip', 'eflags'
+			self.registers = x86_registers
+		elif self.is_x64:
+			self.sp_reg, self.pc_reg, self.flags_reg = 'rsp', 'rip', 'rflags'
+			self.registers = x86_64_registers
+		elif self.is_arm:
+			self.sp_reg, self.pc_reg, self.flags_reg = 'sp', 'pc', 'cpsr'
+			self.registers = arm_32_registers
+		elif self.is_aarch64:
+			self.sp_reg, self.pc_reg, self.flags_reg = 'sp', 'pc', 'cpsr'
+			self.registers = aarch64_registers
+		else:
+			self.sp_reg, self.pc_reg, self.flags_reg = '', '', ''
+			self.registers = []
+
+	def is_current(self, target):
+		return self.target == target and self.process_uid == target.GetProcess().GetUniqueID()
+
+def get_arch_info():
+	global arch_info_cache
+
+	target = lldb.debugger.GetSelectedTarget()
+	if arch_info_cache and arch_info_cache.is_current(target):
+		return arch_info_cache
+
+	arch_info_cache = ArchInfo(target)
+	return arch_info_cache
+
 def is_i386():
-	arch = get_arch()
-	return arch[0:1] == "i"
+	return get_arch_info().is_i386
 
 def is_x64():
-	arch = get_arch()
-	return arch.startswith("x86_64")
+	return get_arch_info().is_x64
 
 def is_arm():
-	arch = get_arch()
-	return arch == "armv7"
+	return get_arch_info().is_arm
 
 def is_aarch64():
-	arch = get_arch()
-	return arch == 'aarch64' or arch.startswith('arm64')
+	return get_arch_info().is_aarch64
 
 def get_pointer_size():
-	poisz = evaluate("sizeof(long)")
-	return poisz
+	return get_arch_info().pointer_size
 
 # from https://github.com/facebook/chisel/blob/master/fblldbobjcruntimehelpers.py
 def get_instance_object():
@@ -196,27 +272,53 @@ def get_instance_object():
 # Register related commands
 # -------------------------
 
+# lldb only names some aarch64 registers by their ABI alias, expose both names
+register_aliases = (('x29', 'fp'), ('x30', 'lr'))
+
+class RegisterFile(dict):
+	'''
+		name -> value of the general purpose registers of a frame, read
+		with a single pass over its register set.
+	'''
+	def __init__(self, frame):
+		super().__init__()
+		regs = get_registers_by_frame(frame, "general")
+		if regs == None:
+			return
+
+		for reg in regs:
+			self[reg.GetName()] = reg.unsigned
+
+		for name, alias in register_aliases:
+			if name in self and alias not in self:
+				self[alias] = self[name]
+			elif alias in self and name not in self:
+				self[name] = self[alias]
+
+# active while the stop hook renders the context on this thread
+stop_render = threading.local()
+
 # return the int value of a general purpose register
 def get_gp_register(reg_name):
-	regs = get_registers("general")
-	if regs == None:
+	registers = get_gp_registers()
+	if registers == None:
 		return 0
-	for reg in regs:
-		if reg_name == reg.GetName():
-			#return int(reg.GetValue(), 16)
-			return reg.unsigned
-	return 0
+	return registers.get(reg_name, 0)
 
+# register file of the current frame. Only the context render uses the stop
+# snapshot, commands read live values since `register write` or `expr $reg=`
+# change registers without a new stop
 def get_gp_registers():
-	regs = get_registers("general")
-	if regs == None:
-		return 0
-	
-	registers = {}
-	for reg in regs:
-		reg_name = reg.GetName()
-		registers[reg_name] = reg.unsigned
-	return registers
+	if getattr(stop_render, 'active', False):
+		ctx = get_stop_context()
+		if ctx == None:
+			return None
+		return ctx.registers
+
+	frame = get_frame()
+	if not frame:
+		return None
+	return RegisterFile(frame)
 
 def get_registers_by_frame(frame, kind):
 	if not frame:
@@ -244,18 +346,12 @@ def get_current_pc():
 	return frame.pc
 
 # retrieve current stack pointer via registers information
-# XXX: add ARM
 def get_current_sp():
-	if is_i386():
-		sp_addr = get_gp_register("esp")
-	elif is_x64():
-		sp_addr = get_gp_register("rsp")
-	elif is_aarch64():
-		sp_addr = get_gp_register("sp")
-	else:
+	arch_info = get_arch_info()
+	if not arch_info.sp_reg:
 		print("[-] get_current_sp() error: wrong architecture.")
 		return 0
-	return sp_addr
+	return get_gp_register(arch_info.sp_reg)
 
 # helper function that updates given register
 def update_register(register, command):
@@ -287,6 +383,57 @@ Where value can be a single value or an expression.
 
 	# we need to format because hex() will return string with an L and that will fail to update register
 	get_frame().reg[register].value = format(value, '#x')
+	# register writes don't bump the stop ID, so drop the snapshot by hand
+	invalidate_stop_context()
+
+# ----------------------------------------------------------
+# Per-stop context snapshot
+# ----------------------------------------------------------
+
+# snapshot shared by the context renderers, rebuilt when the process stop ID changes
+stop_context = None
+
+class StopContext(object):
+	'''
+		Frame, arch, pointer size and register file captured once per stop
+		so the context renderers don't have to query lldb again and again.
+	'''
+	def __init__(self, process, frame):
+		self.process_uid  = process.GetUniqueID()
+		self.stop_id      = process.GetStopID()
+		self.process      = process
+		self.frame        = frame
+		self.thread       = frame.GetThread()
+		self.arch_info    = get_arch_info()
+		self.arch         = self.arch_info.arch
+		self.pointer_size = self.arch_info.pointer_size
+		self.pc           = frame.pc
+		self.sp           = frame.sp
+		self.registers    = RegisterFile(frame)
+
+	def is_current(self, process):
+		return self.process_uid == process.GetUniqueID() and self.stop_id == process.GetStopID()
+
+def get_stop_context():
+	global stop_context
+
+	process = get_process()
+	if not process or not process.IsValid():
+		return None
+
+	if stop_context and stop_context.is_current(process):
+		return stop_context
+
+	frame = get_frame()
+	if not frame:
+		return None
+
+	stop_context = StopContext(process, frame)
+	return stop_context
+
+def invalidate_stop_context():
+	global stop_context
+	stop_context = None
 
 # ----------------------------------------------------------
 # LLDB Module functions
@@ -317,9 +464,120 @@ def resolve_symbol_name(address):
 		return addr_sym.GetName()
 	return ''
 
-def resolve_mem_map(target, addr):
-	found = False
+# ----------------------------------------------------------
+# Address to image section resolution
+# ----------------------------------------------------------
+
+class SectionIndex(object):
+	'''
+		Loaded sections flattened into disjoint address ranges, each one resolving
+		to the section that owns it, so an address is resolved with a single bisect
+		instead of walking every module and section.
+
+		sections is a list of (start, end, module_name, section_name, perms, abs_base)
+		in module order, where abs_base is the section offset inside its image.
+	'''
+	def __init__(self, sections):
+		# overlapping sections (e.g. the shared __LINKEDIT of the dyld cache) resolve
+		# to the first one in module order, like the old linear scan did
+		first_seen = {}
+		for order, section in enumerate(sections):
+			first_seen.setdefault((section[0], section[1]), (order, section))
+		self.sections = [section for order, section in sorted(first_seen.values())]
+
+		# sweep the section bounds, the end address is inclusive like the old scan,
+		# the active sections are kept in a heap by module order
+		bounds = []
+		for order, section in enumerate(self.sections):
+			bounds.append((section[0], order))
+			bounds.append((section[1] + 1, order))
+		bounds.sort()
+
+		self.starts = []
+		self.owners = []
+		active = []
+		removed = set()
+		i = 0
+		while i < len(bounds):
+			addr = bounds[i][0]
+			while i < len(bounds) and bounds[i][0] == addr:
+				order = bounds[i][1]
+				if addr == self.sections[order][0]:
+					heappush(active, order)
+				else:
+					removed.add(order)
+				i += 1
+			while active and active[0] in removed:
+				heappop(active)
+
+			owner = self.sections[active[0]] if active else None
+			if not self.owners or self.owners[-1] is not owner:
+				self.starts.append(addr)
+				self.owners.append(owner)
+
+	def lookup(self, addr):
+		i = bisect_right(self.starts, addr) - 1
+		if i < 0:
+			return None
+		return self.owners[i]
+
+	def __len__(self):
+		return len(self.sections)
+
+def build_section_index(target):
+	sections = []
+	for module in target.modules:
+		module_name = module.file.basename
+		absolute_offset = 0
+		for section in module.sections:
+			start_addr = section.GetLoadAddress(target)
+			if start_addr == 0xffffffffffffffff:
+				continue
+
+			size = section.GetFileByteSize()
+			sections.append((start_addr, start_addr + size, module_name, section.GetName(),
+							section.GetPermissions(), absolute_offset))
+			absolute_offset += size
+
+	return SectionIndex(sections)
+
+# section index of the selected target, rebuilt on module load/unload events
+section_index_cache = None
+
+class SectionIndexCache(object):
+	def __init__(self, target):
+		self.target = target
+		self.listener = lldb.SBListener('lldbinit.section_index')
+		target.GetBroadcaster().AddListener(self.listener,
+			lldb.SBTarget.eBroadcastBitModulesLoaded | lldb.SBTarget.eBroadcastBitModulesUnloaded)
+		self.rebuild()
+
+	def rebuild(self):
+		self.process_uid = self.target.GetProcess().GetUniqueID()
+		self.num_modules = self.target.GetNumModules()
+		self.index = build_section_index(self.target)
+
+	def is_stale(self):
+		# drain pending module events, any of them means the layout changed
+		stale = False
+		event = lldb.SBEvent()
+		while self.listener.GetNextEvent(event):
+			stale = True
 
+		return stale or self.process_uid != self.target.GetProcess().GetUniqueID() or \
+			self.num_modules != self.target.GetNumModules()
+
+def get_section_index(target):
+	global section_index_cache
+
+	if not section_index_cache or section_index_cache.target != target:
+		section_index_cache = SectionIndexCache(target)
+	elif section_index_cache.is_stale():
+		section_index_cache.rebuild()
+
+	return section_index_cache.index
+
+def resolve_mem_map(target, addr):
 	xinfo = {
 		'module_name' : '',
 		'section_name' : '',
@@ -328,24 +586,14 @@ def resolve_mem_map(target, addr):
 		'abs_offset' : -1
 	}
 
-	# found in load image
-	for module in target.modules:
-		absolute_offset = 0
-		for section in module.sections:
-			if section.GetLoadAddress(target) == 0xffffffffffffffff:
-				continue
-
-			start_addr = section.GetLoadAddress(target)
-			end_addr = start_addr + section.GetFileByteSize()
-			if start_addr <= addr <= end_addr:
-				xinfo['module_name'] = module.file.basename
-				xinfo['section_name'] = section.GetName()
-				xinfo['perms'] = section.GetPermissions()
-				xinfo['offset'] = addr - start_addr
-				xinfo['abs_offset'] = absolute_offset + xinfo['offset']
-				return xinfo
-
-			absolute_offset += section.GetFileByteSize()
+	section = get_section_index(target).lookup(addr)
+	if section:
+		start_addr, end_addr, module_name, section_name, perms, abs_base = section
+		xinfo['module_name'] = module_name
+		xinfo['section_name'] = section_name
+		xinfo['perms'] = perms
+		xinfo['offset'] = addr - start_addr
+		xinfo['abs_offset'] = abs_base + xinfo['offset']
 
 	return xinfo
 
@@ -369,9 +617,13 @@ def parse_number(str_num):
 
 	return str_num
 
-vmmap_caches = []
+# ----------------------------------------------------------
+# Memory Map Providers
+# ----------------------------------------------------------
 
 class MapInfo(object):
+	__slots__ = ('type', 'start', 'end', 'perm', 'shm', 'region')
+
 	def __init__(self, _type, start, end, perm, shm, region):
 		self.type  = _type
 		self.start = start
@@ -380,58 +632,133 @@ class MapInfo(object):
 		self.shm   = shm
 		self.region= region
 
+	def key(self):
+		return (self.start, self.end, self.type, self.perm, self.shm, self.region)
+
 	def __hash__(self):
-		s = self.type
-		s+= str(self.start)
-		s+= str(self.end)
-		s+= self.perm
-		s+= self.shm
-		s+= self.region
-		return hash(s)
+		return hash(self.key())
 
 	def __eq__(self, other):
-		return hash(self) == hash(other)
+		return isinstance(other, MapInfo) and self.key() == other.key()
 
 	def __ne__(self, other):
-		return hash(self) != hash(other)
+		return not self.__eq__(other)
 
+	# records order by address
 	def __lt__(self, other):
-		return hash(self) < hash(other)
+		return self.key() < other.key()
 
 	def __le__(self, other):
-		return hash(self) <= hash(other)
+		return self.key() <= other.key()
 
 	def __gt__(self, other):
-		return hash(self) > hash(other)
+		return self.key() > other.key()
 
 	def __ge__(self, other):
-		return hash(self) >= hash(other)
+		return self.key() >= other.key()
+
+def perm_string(readable, writable, executable):
+	perm = 'r' if readable else '-'
+	perm+= 'w' if writable else '-'
+	perm+= 'x' if executable else '-'
+	return perm
+
+def region_type(pathname):
+	# vmmap style label of a Linux style region name
+	if pathname.startswith('[stack'):
+		return 'Stack'
+	if pathname == '[heap]':
+		return 'MALLOC'
+	if pathname.startswith('['):
+		return pathname
+	if pathname:
+		return Path(pathname).name
+	return 'anonymous'
+
+def is_host_process(process):
+	return process.GetTarget().GetPlatform().GetName() == 'host'
+
+def proc_maps_provider(process):
+	# /proc/<pid>/maps only describes processes running on this Linux host
+	if platform.system() != 'Linux':
+		return None
 
-def get_vmmap_info():
-	if platform.system() != 'Darwin':
-		print('[!] This feature only support on macOS')
-		return ''
+	if not is_host_process(process):
+		return None
 
-	process = get_process()
-	if not process:
-		return ''
+	try:
+		with open('/proc/{0}/maps'.format(process.GetProcessID()), 'r') as f:
+			lines = f.read().splitlines()
+	except (IOError, OSError):
+		return None
+
+	map_infos = []
+	for line in lines:
+		# start-end perms offset dev inode [pathname]
+		fields = line.split(None, 5)
+		if len(fields) < 5:
+			continue
+
+		start, end = fields[0].split('-')
+		perms = fields[1]
+		pathname = fields[5] if len(fields) == 6 else ''
+
+		_type = region_type(pathname)
+		shm = 'SM=SHM' if perms[3:4] == 's' else 'SM=PRV'
+		map_infos.append(MapInfo(_type, int(start, 16), int(end, 16), perms[:3], shm, pathname))
 
+	return map_infos
+
+def memory_regions_provider(process):
+	# generic backend for remote and core processes, regions only carry the
+	# names lldb knows, [heap] and [stack] of Linux targets get vmmap's labels
+	regions = process.GetMemoryRegions()
+	if not regions or not regions.GetSize():
+		return None
+
+	stack_pointers = []
+	for thread in process:
+		frame = thread.GetFrameAtIndex(0)
+		if frame.IsValid():
+			stack_pointers.append(frame.GetSP())
+
+	map_infos = []
+	region = lldb.SBMemoryRegionInfo()
+	for i in range(regions.GetSize()):
+		if not regions.GetMemoryRegionAtIndex(i, region):
+			continue
+		if not region.IsMapped():
+			continue
+
+		start = region.GetRegionBase()
+		end = region.GetRegionEnd()
+		name = region.GetName() or ''
+
+		if any(start <= sp < end for sp in stack_pointers):
+			_type = 'Stack'
+		else:
+			_type = region_type(name)
+
+		perm = perm_string(region.IsReadable(), region.IsWritable(), region.IsExecutable())
+		map_infos.append(MapInfo(_type, start, end, perm, '', name))
+
+	return map_infos
+
+def get_vmmap_info(process):
 	process_info = process.GetProcessInfo()
 	if not process_info.IsValid():
 		return ''
 
 	cmd = ['vmmap', str(process_info.GetProcessID())]
-	proc = Popen(cmd, stdout = PIPE)
+	try:
+		proc = Popen(cmd, stdout = PIPE)
+	except OSError:
+		return ''
 	out, err = proc.communicate()
 
-	return out.decode('utf-8')
-
-def parse_vmmap_info():
-	vmmap_info = get_vmmap_info()
-
-	if not vmmap_info:
-		return
+	return out.decode('utf-8', 'replace')
 
+def parse_vmmap_info(vmmap_info):
 	match_map = re.findall(
 		r'([\x20-\x7F]+)\s+([0-9a-f]+)\-([0-9a-f]+)\s+\[[0-9KMG\.\s]+\]\s+([rwx\-/]+)\s+([A-Za-z=]+)\s+([\x20-\x7F]+)',
 		vmmap_info
@@ -440,83 +767,281 @@ def parse_vmmap_info():
 	if not match_map:
 		print('[-] Vmmap parse error')
 		print(vmmap_info)
-		return
+		return None
 
-	for m in match_map:
-		o_map_info = MapInfo(m[0], int(m[1], 16), int(m[2], 16), m[3], m[4], m[5])
-		if o_map_info not in vmmap_caches:
-			# add to caches
-			vmmap_caches.append(o_map_info)
+	return [MapInfo(m[0].strip(), int(m[1], 16), int(m[2], 16), m[3], m[4], m[5]) for m in match_map]
 
-	return vmmap_caches
+def vmmap_provider(process):
+	# local macOS processes, vmmap labels heap regions (MALLOC_*) which lldb can't
+	if platform.system() != 'Darwin' or not is_host_process(process):
+		return None
 
-def query_vmmap(address):
-	global vmmap_caches
+	vmmap_info = get_vmmap_info(process)
+	if not vmmap_info:
+		return None
 
-	if platform.system() != 'Darwin':
-		print('[!] This feature only support on macOS')
+	return parse_vmmap_info(vmmap_info)
+
+# tried in order, the first one returning regions wins, the local providers come
+# first since their labels are what telescope, vmmap and dump MALLOC_* rely on
+memory_map_providers = [proc_maps_provider, vmmap_provider, memory_regions_provider]
+
+class RegionIndex(object):
+	'''
+		Mapped regions sorted by start address and made non-overlapping, so an
+		address resolves with a single bisect.
+	'''
+	def __init__(self, map_infos):
+		self.regions = []
+		end = -1
+		for map_info in sorted(map_infos, key=lambda m: (m.start, -m.end)):
+			# vmmap reports submaps inside their parent region, keep the outer one
+			if map_info.start < end:
+				continue
+			self.regions.append(map_info)
+			end = map_info.end
+
+		self.starts = [map_info.start for map_info in self.regions]
+
+	def lookup(self, addr):
+		i = bisect_right(self.starts, addr) - 1
+		if i >= 0 and addr < self.regions[i].end:
+			return self.regions[i]
 		return None
 
-	for map_info in vmmap_caches:
-		if map_info.start <= address < map_info.end:
-			return map_info
+	def overlapping(self, start, end):
+		''' regions intersecting [start, end) in address order '''
+		i = max(bisect_right(self.starts, start) - 1, 0)
+		while i < len(self.regions) and self.regions[i].start < end:
+			if self.regions[i].end > start:
+				yield self.regions[i]
+			i += 1
+
+	def __iter__(self):
+		return iter(self.regions)
+
+	def __len__(self):
+		return len(self.regions)
+
+# bumped whenever something may have mapped or unmapped memory without a stop
+memory_map_generation = 0
+region_index = None
+region_index_stamp = None
+
+def get_region_index(refresh=False):
+	global region_index, region_index_stamp
 
 	process = get_process()
-	process_info = process.GetProcessInfo()
-	if not process_info.IsValid():
-		return None
+	if not process or not process.IsValid():
+		return RegionIndex([])
 
-	cmd = ['vmmap', str(process_info.GetProcessID()), hex(address)]
-	proc = Popen(cmd, stdout = PIPE)
-	out, err = proc.communicate()
-	out = out.decode('utf-8')
+	if refresh:
+		invalidate_memory_maps()
 
-	m = re.search(
-		r'\-\-\->\s+([\x20-\x7F]+)\s+([0-9a-f]+)\-([0-9a-f]+)\s+\[[0-9KMG\.\s]+\]\s+([rwx\-/]+)\s+([A-Za-z=]+)\s+([\x20-\x7F]+)',
-		out
-	)
-	if not m:
-		return None
+	# maps can only change while the process runs, one build per stop is enough,
+	# expression stops count too since an expression may mmap/munmap
+	stamp = (process.GetUniqueID(), process.GetStopID(True), memory_map_generation)
+	if region_index is None or region_index_stamp != stamp:
+		map_infos = []
+		for provider in memory_map_providers:
+			map_infos = provider(process)
+			if map_infos:
+				break
+
+		region_index = RegionIndex(map_infos or [])
+		region_index_stamp = stamp
+
+	return region_index
 
-	map_info = MapInfo(m[1], int(m[2], 16), int(m[3], 16), m[4], m[5], m[6])
-	if map_info not in vmmap_caches:
-		# save this query map into caches
-		vmmap_caches.append(map_info)
+def get_memory_maps(refresh=False):
+	''' sorted MapInfo list of the current process '''
+	return get_region_index(refresh).regions
 
-	return map_info
+def invalidate_memory_maps():
+	global memory_map_generation
+	memory_map_generation += 1
+
+def query_vmmap(address):
+	return get_region_index().lookup(address)
 
 # ----------------------------------------------------------
 # Memory Read/Write Support
 # ----------------------------------------------------------
 
-def read_mem(addr, size):
-	err = lldb.SBError()
-	process = get_process()
+MEMORY_PAGE_SIZE = 0x1000
+# code unit size of the string encodings read_string understands
+STRING_ENCODINGS = {'utf-8': 1, 'utf-16': 2, 'utf-32': 4}
+
+# target memory kept for one stop, least recently used pages go first
+MEMORY_CACHE_BUDGET = 0x100000
+# reads larger than this go straight to the target
+MEMORY_CACHE_MAX_READ = 0x10000
+
+memory_cache_generation = 0
+
+class MemoryCache(object):
+	''' LRU cache of target memory pages, only valid for one stop '''
+	def __init__(self, budget=MEMORY_CACHE_BUDGET):
+		self.budget = budget
+		# page number -> page bytes, None when the page is unreadable
+		self.pages = OrderedDict()
+		self.size = 0
+		self.stamp = None
+		self.lock = threading.Lock()
+
+	def clear(self):
+		self.pages.clear()
+		self.size = 0
+
+	def add(self, page, data):
+		self.pages[page] = data
+		if data:
+			self.size += len(data)
+		while self.size > self.budget:
+			_, evicted = self.pages.popitem(last=False)
+			if evicted:
+				self.size -= len(evicted)
+
+	def fetch(self, process, first, count):
+		''' read count pages from first, False at the first unreadable one '''
+		err = lldb.SBError()
+		size = count * MEMORY_PAGE_SIZE
+		data = process.ReadMemory(first * MEMORY_PAGE_SIZE, size, err)
+		if err.Success() and data and len(data) == size:
+			for i in range(count):
+				self.add(first + i, data[i * MEMORY_PAGE_SIZE:(i + 1) * MEMORY_PAGE_SIZE])
+			return True
+		if count == 1:
+			self.add(first, None)
+			return False
 
-	mem_data = process.ReadMemory(addr, size, err)
-	if not err.Success():
+		# the run has a hole, find it page by page
+		for page in range(first, first + count):
+			data = process.ReadMemory(page * MEMORY_PAGE_SIZE, MEMORY_PAGE_SIZE, err)
+			if not err.Success() or not data or len(data) != MEMORY_PAGE_SIZE:
+				self.add(page, None)
+				return False
+			self.add(page, data)
+		return True
+
+	def read(self, process, addr, size):
+		with self.lock:
+			# any resume, expression or write starts over
+			stamp = (process.GetUniqueID(), process.GetStopID(True), memory_cache_generation)
+			if stamp != self.stamp:
+				self.clear()
+				self.stamp = stamp
+
+			first = addr // MEMORY_PAGE_SIZE
+			last = (addr + size - 1) // MEMORY_PAGE_SIZE
+			missing = []
+			for page in range(first, last + 1):
+				if page not in self.pages:
+					missing.append(page)
+				elif self.pages[page] == None:
+					return None
+
+			# one read per run of consecutive missing pages
+			i = 0
+			while i < len(missing):
+				j = i
+				while j + 1 < len(missing) and missing[j + 1] == missing[j] + 1:
+					j += 1
+				if not self.fetch(process, missing[i], j - i + 1):
+					return None
+				i = j + 1
+
+			chunks = []
+			for page in range(first, last + 1):
+				self.pages.move_to_end(page)
+				chunks.append(self.pages[page])
+			offset = addr - first * MEMORY_PAGE_SIZE
+			return b''.join(chunks)[offset:offset + size]
+
+memory_cache = MemoryCache()
+
+def invalidate_memory_cache():
+	global memory_cache_generation
+	memory_cache_generation += 1
+
+def read_memory(process, addr, size):
+	'''
+	ReadMemory, None when the range isn't readable. Only the context render
+	reads through the page cache, an lldb `memory write` doesn't change the
+	stop ID so commands always read the target
+	'''
+	if size <= 0:
+		return b''
+	if not getattr(stop_render, 'active', False) or size > MEMORY_CACHE_MAX_READ \
+			or process.GetState() != lldb.eStateStopped:
+		err = lldb.SBError()
+		data = process.ReadMemory(addr, size, err)
+		if not err.Success() or not data:
+			return None
+		return data
+	return memory_cache.read(process, addr, size)
+
+def read_mem(addr, size):
+	mem_data = read_memory(get_process(), addr, size)
+	if mem_data == None:
 		mem_data = b''
 
 	return mem_data
 
-def read_str(addr, size):
-	err = lldb.SBError()
+def read_str_bytes(addr, max_size, char_size=1):
+	'''
+	Read a NUL terminated string of char_size code units, at most max_size bytes.
+	Reads run to the end of each page and the terminator is found with
+	bytes.find, the string stops at the first unreadable page.
+	Return (data, complete), complete is False when unreadable memory ended
+	the string before its terminator or max_size
+	'''
 	process = get_process()
+	terminator = b'\x00' * char_size
+
+	data = bytearray()
+	while len(data) < max_size:
+		cur = addr + len(data)
+		size = min(MEMORY_PAGE_SIZE - cur % MEMORY_PAGE_SIZE, max_size - len(data))
+		# reads never cross a page, a failed one means the page is unreadable
+		chunk = read_memory(process, cur, size)
+		if not chunk:
+			return bytes(data), False
+
+		# only code unit aligned terminators count
+		start = len(data) - len(data) % char_size
+		data += chunk
+		pos = data.find(terminator, start)
+		while pos != -1 and pos % char_size:
+			pos = data.find(terminator, pos + 1)
+		if pos != -1:
+			return bytes(data[:pos]), True
+
+	return bytes(data[:max_size]), True
 
-	c_str = b''
-	for i in range(size):
-		c = process.ReadMemory(addr + i, 1, err)
-		if not err.Success():
-			c_str = b''
-			break
-		
-		if c == b'\x00':
-			break
-		
-		c_str += c
-			
+def read_str(addr, size):
+	c_str, complete = read_str_bytes(addr, size)
+	if not complete:
+		return b''
 	return c_str
 
+def read_string(addr, max_length=0x1000, encoding='utf-8'):
+	'''
+	Read and decode a NUL terminated utf-8, utf-16 or utf-32 string of at most
+	max_length code units, return None when addr isn't readable
+	'''
+	char_size = STRING_ENCODINGS[encoding]
+	data, complete = read_str_bytes(addr, max_length * char_size, char_size)
+	if not data and not complete:
+		return None
+
+	if char_size > 1:
+		data = data[:len(data) - len(data) % char_size]
+		target = get_target()
+		big_endian = target != None and target.GetByteOrder() == lldb.eByteOrderBig
+		encoding += '-be' if big_endian else '-le'
+	return data.decode(encoding, 'replace')
+
 def write_mem(addr, data):
 	err = lldb.SBError()
 	process = get_process()
@@ -524,26 +1049,331 @@ def write_mem(addr, data):
 	sz_write = process.WriteMemory(addr, data, err)
 	if not err.Success():
 		sz_write = 0
+	invalidate_memory_cache()
+	invalidate_instruction_cache()
 
 	return sz_write
 
-def try_read_mem(addr, size):
-	err = lldb.SBError()
-	process = get_process()
+def read_mem_prefix(addr, size, process=None):
+	'''
+	Largest readable prefix of [addr, addr + size). Readability only changes
+	on page boundaries, so when the whole range fails binary search how many
+	of its pages read back, O(log pages) reads instead of one per byte
+	'''
+	if size <= 0:
+		return b''
+	if process == None:
+		process = get_process()
+
+	mem_data = read_memory(process, addr, size)
+	if mem_data:
+		return mem_data
+
+	# candidate prefixes end on the page boundaries inside the range
+	first = MEMORY_PAGE_SIZE - addr % MEMORY_PAGE_SIZE
+	if first >= size:
+		return b''
+	lo = 0
+	hi = (size - first + MEMORY_PAGE_SIZE - 1) // MEMORY_PAGE_SIZE
 	mem_data = b''
+	while lo < hi:
+		mid = (lo + hi) // 2
+		chunk = read_memory(process, addr, first + mid * MEMORY_PAGE_SIZE)
+		if chunk:
+			mem_data = chunk
+			lo = mid + 1
+		else:
+			hi = mid
+
+	return mem_data
+
+def read_mem_masked(addr, size, process=None):
+	'''
+	Read [addr, addr + size) around unreadable pages.
+	Return (data, mask), both size bytes long: unreadable bytes are 0 in data
+	and 0 in mask, readable bytes are 1 in mask
+	'''
+	if process == None:
+		process = get_process()
+
+	prefix = read_mem_prefix(addr, size, process)
+	if len(prefix) == size:
+		return prefix, b'\x01' * size
+
+	data = bytearray(size)
+	mask = bytearray(size)
+	data[:len(prefix)] = prefix
+	mask[:len(prefix)] = b'\x01' * len(prefix)
+
+	# the page after the prefix is unreadable, try each following page once
+	offset = (addr + len(prefix)) // MEMORY_PAGE_SIZE * MEMORY_PAGE_SIZE + MEMORY_PAGE_SIZE - addr
+	while offset < size:
+		chunk_size = min(MEMORY_PAGE_SIZE, size - offset)
+		chunk = read_memory(process, addr + offset, chunk_size)
+		if chunk:
+			data[offset:offset + len(chunk)] = chunk
+			mask[offset:offset + len(chunk)] = b'\x01' * len(chunk)
+		offset += chunk_size
+
+	return bytes(data), bytes(mask)
+
+def try_read_mem(addr, size):
+	return read_mem_prefix(addr, size)
+
+# bytes read and handed out at once while streaming large ranges
+DUMP_CHUNK_SIZE = 0x100000
+
+def mask_holes(addr, mask):
+	''' (start, end) address ranges of the unreadable bytes of a mask '''
+	holes = []
+	pos = mask.find(b'\x00')
+	while pos != -1:
+		end = mask.find(b'\x01', pos)
+		if end == -1:
+			end = len(mask)
+		holes.append((addr + pos, addr + end))
+		pos = mask.find(b'\x00', end)
+	return holes
+
+def read_mem_chunks(start, end, chunk_size=DUMP_CHUNK_SIZE, process=None):
+	'''
+	Yield (addr, data, mask) chunks covering [start, end) like read_mem_masked.
+	When the memory map is known, unmapped and unreadable regions become holes
+	without being read.
+	'''
+	if process == None:
+		process = get_process()
+
+	index = get_region_index()
+	addr = start
+	while addr < end:
+		size = min(chunk_size, end - addr)
+		if not len(index):
+			data, mask = read_mem_masked(addr, size, process)
+		else:
+			data = bytearray(size)
+			mask = bytearray(size)
+			for region in index.overlapping(addr, addr + size):
+				if 'r' not in region.perm.split('/')[0]:
+					continue
+				lo = max(region.start, addr)
+				hi = min(region.end, addr + size)
+				part, part_mask = read_mem_masked(lo, hi - lo, process)
+				data[lo - addr:hi - addr] = part
+				mask[lo - addr:hi - addr] = part_mask
+		yield addr, data, mask
+		addr += size
+
+# ----------------------------------------------------------
+# Disassembly cache
+# ----------------------------------------------------------
+
+CODE_PAGE_SIZE = 0x1000
+# drop everything past this many decoded instructions, a full context is ~30
+INSTRUCTION_CACHE_MAX = 0x10000
+
+class Instruction(object):
+	''' decoded instruction, detached from the SBInstruction it came from '''
+	__slots__ = ('address', 'size', 'mnemonic', 'operands', 'comment', 'data', 'does_branch')
+
+	def __init__(self, target, sb_instruction):
+		self.address     = sb_instruction.GetAddress().GetLoadAddress(target)
+		self.size        = sb_instruction.GetByteSize()
+		self.mnemonic    = sb_instruction.GetMnemonic(target)
+		self.operands    = sb_instruction.GetOperands(target)
+		self.comment     = sb_instruction.GetComment(target)
+		self.data        = bytes(sb_instruction.GetData(target).uint8)
+		self.does_branch = sb_instruction.DoesBranch()
+
+	def pages(self):
+		first = self.address // CODE_PAGE_SIZE
+		last = (self.address + max(self.size, 1) - 1) // CODE_PAGE_SIZE
+		return range(first, last + 1)
+
+class InstructionCache(object):
+	'''
+		Decoded instructions by load address. Each code page keeps the crc32 of
+		the bytes its instructions were decoded from, it is checked again once per
+		stamp (stop or memory write) so patched and self-modifying code is decoded anew.
+	'''
+	def __init__(self, target):
+		self.target = target
+		self.instructions = {}
+		self.pages = {}        # page -> addresses of instructions on it
+		self.page_crcs = {}
+		self.page_stamps = {}
+
+	def check_page(self, process, stamp, page):
+		if self.page_stamps.get(page) == stamp:
+			return page in self.page_crcs
+		self.page_stamps[page] = stamp
+
+		error = lldb.SBError()
+		data = process.ReadMemory(page * CODE_PAGE_SIZE, CODE_PAGE_SIZE, error)
+		crc = zlib.crc32(data) if error.Success() else None
+
+		if crc != self.page_crcs.get(page):
+			for address in self.pages.pop(page, ()):
+				self.instructions.pop(address, None)
+			if crc is None:
+				self.page_crcs.pop(page, None)
+			else:
+				self.page_crcs[page] = crc
+
+		return crc is not None
 
-	# heuristic check address
-	# if (not (addr & 0xFFFFFF0000000000)) or (not (addr & 0x7ffffffff000)):
-	# 	return b''
+	def lookup(self, process, stamp, address):
+		instruction = self.instructions.get(address)
+		if not instruction:
+			return None
+
+		for page in instruction.pages():
+			if not self.check_page(process, stamp, page):
+				return None
+
+		# a changed page drops its instructions, including this one
+		return self.instructions.get(address)
+
+	def add(self, process, stamp, instruction):
+		if instruction.address == lldb.LLDB_INVALID_ADDRESS:
+			return
+
+		if len(self.instructions) >= INSTRUCTION_CACHE_MAX:
+			# page checksums and stamps go too, they'd grow with every page ever seen
+			self.instructions.clear()
+			self.pages.clear()
+			self.page_crcs.clear()
+			self.page_stamps.clear()
+
+		for page in instruction.pages():
+			# unreadable code can't be validated later, don't keep it
+			if not self.check_page(process, stamp, page):
+				return
+
+		self.instructions[instruction.address] = instruction
+		for page in instruction.pages():
+			self.pages.setdefault(page, set()).add(instruction.address)
+
+instruction_cache = None
+# bumped on every memory write so patches are seen without a new stop
+code_generation = 0
+
+def invalidate_instruction_cache():
+	global code_generation
+	code_generation += 1
 
-	while size != 0:
-		mem_data = process.ReadMemory(addr, size, err)
-		if err.Success():
+def get_instructions(address, count=1):
+	''' decode count instructions from address, reusing cached ones '''
+	global instruction_cache
+
+	target = get_target()
+	process = target.GetProcess()
+
+	if not instruction_cache or instruction_cache.target != target:
+		instruction_cache = InstructionCache(target)
+
+	stamp = (process.GetUniqueID(), process.GetStopID(True), code_generation)
+
+	instructions = []
+	while len(instructions) < count:
+		instruction = instruction_cache.lookup(process, stamp, address)
+		if not instruction:
 			break
+		instructions.append(instruction)
+		address += instruction.size
+
+	if len(instructions) < count:
+		# decode the rest of the window in a single call
+		sb_instructions = target.ReadInstructions(lldb.SBAddress(address, target),
+												count - len(instructions), 'intel')
+		for sb_instruction in sb_instructions:
+			instruction = Instruction(target, sb_instruction)
+			instruction_cache.add(process, stamp, instruction)
+			instructions.append(instruction)
+
+	return instructions
+
+def get_instruction(address):
+	instructions = get_instructions(address, 1)
+	if not instructions:
+		return None
+	return instructions[0]
 
-		size -= 1
+# ----------------------------------------------------------
+# Memory search
+# ----------------------------------------------------------
 
-	return mem_data
+# size of the window read from the target per ReadMemory call while searching
+FINDMEM_CHUNK_SIZE = 0x100000
+
+class PatternSet(object):
+	'''
+		Byte patterns matched together, each one searched with bytes.find. The
+		next occurrence of every pattern is kept in a heap and the earliest one
+		wins, the longest pattern when several start at the same address.
+		Matches never overlap, whatever the number of patterns.
+	'''
+	def __init__(self, patterns):
+		self.patterns = patterns
+		# bytes a match may run past the window it starts in
+		self.overlap = max(len(pattern) for pattern in patterns) - 1
+
+	def finditer(self, buf, pos, limit):
+		'''
+			Yield (index, pattern_id) for every match in buf starting in [pos, limit),
+			each one searched for after the end of the previous.
+		'''
+		patterns = self.patterns
+		heap = []
+		for pattern_id, pattern in enumerate(patterns):
+			idx = buf.find(pattern, pos, limit + len(pattern) - 1)
+			if idx != -1:
+				heap.append((idx, -len(pattern), pattern_id))
+		heapify(heap)
+
+		while heap:
+			idx, neg_len, pattern_id = heap[0]
+			if idx >= pos:
+				yield idx, pattern_id
+				pos = idx - neg_len
+			# the occurrence was reported or overlaps the one that was, find the next
+			pattern = patterns[pattern_id]
+			idx = buf.find(pattern, pos, limit + len(pattern) - 1)
+			if idx == -1:
+				heappop(heap)
+			else:
+				heapreplace(heap, (idx, -len(pattern), pattern_id))
+
+def find_in_region(process, start, end, matcher, chunk_size=FINDMEM_CHUNK_SIZE):
+	'''
+		Yield (address, pattern_id) for every non-overlapping match of the
+		PatternSet matcher in [start, end).
+
+		The region is read in chunk_size windows, each extended by the longest
+		pattern length - 1 bytes so matches straddling two windows are still found.
+		Memory usage is bounded by the window size whatever the size of the region.
+	'''
+	overlap = matcher.overlap
+	# first address a new match may start at, skips the tail of the previous match
+	next_addr = start
+	err = lldb.SBError()
+
+	window_start = start
+	while window_start < end:
+		window_end = min(window_start + chunk_size + overlap, end)
+		buf = process.ReadMemory(window_start, window_end - window_start, err)
+		if not err.Success() or not buf:
+			# unreadable window, move on to the next one
+			window_start += chunk_size
+			continue
+
+		# only report matches starting inside this window, the overlap belongs to the next one
+		limit = min(chunk_size, len(buf))
+		for idx, pattern_id in matcher.finditer(buf, max(next_addr - window_start, 0), limit):
+			yield window_start + idx, pattern_id
+			next_addr = window_start + idx + len(matcher.patterns[pattern_id])
+
+		window_start += chunk_size
 
 def size_of(struct_name):
 	res = lldb.SBCommandReturnObject()
@@ -681,117 +1511,526 @@ class ESBValue(object):
 		return self
 
 # ----------------------------------------------------------
-# Cyclic algorithm to find offset on memory
+# Basic block coverage
 # ----------------------------------------------------------
 
-def de_bruijn(charset , n = 4, maxlen = 0x10000):
-		# string cyclic function
-		# this code base on https://github.com/Gallopsled/pwntools/blob/master/pwnlib/util/cyclic.py
-		# Taken from https://en.wikipedia.org/wiki/De_Bruijn_sequence but changed to a generator
-		"""de_bruijn(charset = string.ascii_lowercase, n = 4) -> generator
-
-		Generator for a sequence of unique substrings of length `n`. This is implemented using a
-		De Bruijn Sequence over the given `charset`.
-
-		The returned generator will yield up to ``len(charset)**n`` elements.
-
-		Arguments:
-		  charset: List or string to generate the sequence over.
-		  n(int): The length of subsequences that should be unique.
-		"""
-		k = len(charset)
-		a = [0] * k * n
-		sequence = []
-		def db(t, p):
-			if len(sequence) == maxlen:
-				return
-			if t > n:
-				if n % p == 0:
-					for j in range(1	, p + 1):
-						sequence.append(charset[a[j]])
-						if len(sequence) == maxlen:
-							return
-			else:
-				a[t] = a[t - p]
-				db(t + 1, p)
-
-				for j in range(a[t - p] + 1, k):
-					a[t] = j
-					db(t + 1, t)
-		db(1,1)
-		return bytearray(sequence)
-
-# generate a cyclic string
-def cyclic(length = None, n = 4):
-	charset = [b'ABCDEFGHIJKLMNOPQRSTUVWXYZ', b'%$-;abcdefghijklmopqrtuvwxyz', b'sn()0123456789']
-	mixed_charset = mixed = b''
-	k = 0
-	while True:
-		for i in range(0, len(charset)): mixed += charset[i][k:k+1]
-		if not mixed: break
-		mixed_charset += mixed
-		mixed = b''
-		k+=1
-
-	pattern = de_bruijn(mixed_charset, 3, length)
-	return pattern
-
-def cyclic_find(subseq, length = 0x10000):
-	# finding subseq in generator then return pos of this subseq
-	# if it doens't find then return -1
-	generator = cyclic(length)
-
-	if isinstance(subseq, int): # subseq might be a number or hex value
-		try:
-			subseq = p32(subseq)
-		except error: # struct.error
-			try:
-				subseq = p64(subseq)
-			except error: # struct.error
-				return -1
-	
-	if not isinstance(subseq, bytes):
-		return -1
-	# finding position of subseq
-	subseq = bytearray(subseq)
-	saved = bytearray([])
-	pos = 0
-
-	for c in generator:
-		saved.append(c)
-		if len(saved) > len(subseq):
-			saved.pop(0)
+# direct branch target, always the last operand (jmp 0x.., b.eq 0x.., cbz x0, 0x..)
+branch_target_re = re.compile(r'(0x[0-9a-f]+)\s*$')
+
+def get_module_range(target, module):
+	''' load address of the module header and end of its highest loaded section '''
+	base = module.GetObjectFileHeaderAddress().GetLoadAddress(target)
+	end = base
+	for section in module.sections:
+		start_addr = section.GetLoadAddress(target)
+		if start_addr == lldb.LLDB_INVALID_ADDRESS:
+			continue
+		end = max(end, start_addr + section.GetByteSize())
+
+	return base, end
+
+def get_basic_blocks(target, module):
+	'''
+		{block load address: block size} of every code symbol in module.
+		Blocks start at the symbol, after any branch and at direct branch
+		targets inside the symbol, found by a linear sweep of its instructions.
+	'''
+	blocks = {}
+	for symbol in module.symbols:
+		if symbol.GetType() != lldb.eSymbolTypeCode:
+			continue
+
+		start = symbol.GetStartAddress().GetLoadAddress(target)
+		end = symbol.GetEndAddress().GetLoadAddress(target)
+		if start == lldb.LLDB_INVALID_ADDRESS or end == lldb.LLDB_INVALID_ADDRESS or end <= start:
+			continue
+
+		addresses = set()
+		heads = set([start])
+		for instruction in symbol.GetInstructions(target, 'intel'):
+			addr = instruction.GetAddress().GetLoadAddress(target)
+			addresses.add(addr)
+			if not instruction.DoesBranch():
+				continue
+
+			heads.add(addr + instruction.GetByteSize())
+			m = branch_target_re.search(instruction.GetOperands(target))
+			if m:
+				heads.add(int(m.group(1), 16))
+
+		# a block runs until the next head or the end of the symbol
+		heads = sorted(head for head in heads if head in addresses)
+		for i, head in enumerate(heads):
+			block_end = heads[i + 1] if i + 1 < len(heads) else end
+			blocks[head] = block_end - head
+
+	return blocks
+
+def write_drcov(path, modules, blocks):
+	'''
+		drcov v2 log, the format lighthouse and other coverage tools load.
+		modules: list of (base, end, path), blocks: list of (module_id, offset, size)
+	'''
+	with open(path, 'wb') as f:
+		f.write(b'DRCOV VERSION: 2\n')
+		f.write(b'DRCOV FLAVOR: drcov\n')
+		f.write('Module Table: version 2, count {0}\n'.format(len(modules)).encode('utf-8'))
+		f.write(b'Columns: id, base, end, entry, checksum, timestamp, path\n')
+		for module_id, (base, end, module_path) in enumerate(modules):
+			f.write('{0:3d}, 0x{1:016x}, 0x{2:016x}, 0x0000000000000000, 0x00000000, 0x00000000, {3}\n'.format(
+				module_id, base, end, module_path).encode('utf-8'))
+
+		f.write('BB Table: {0} bbs\n'.format(len(blocks)).encode('utf-8'))
+		for module_id, offset, size in blocks:
+			f.write(pack('<IHH', offset, min(size, 0xFFFF), module_id))
+
+# binary coverage trace written by cov, see read_coverage() for the layout
+COVERAGE_MAGIC = b'LLDBCOV\x02'
+COVERAGE_HEADER = '<8sQQ'
+# encoded records buffered before a flush
+COVERAGE_FLUSH_SIZE = 0x80000
+# module ids are stored as u16 and offsets as u32
+COVERAGE_MAX_MODULES = 0x10000
+COVERAGE_MAX_OFFSET = 0xFFFFFFFF
+
+class CoverageSink(object):
+	'''
+		(module_id, offset) records delta encoded against the previous offset in
+		the same module, as varints in a bytearray flushed in large blocks. A
+		step to the next instruction mostly takes a single byte. The module table
+		is appended on close and the header patched with its offset.
+	'''
+	def __init__(self, path):
+		self.path = path
+		self.file = open(path, 'wb')
+		self.file.write(pack(COVERAGE_HEADER, COVERAGE_MAGIC, 0, 0))
+		self.buffer = bytearray()
+		self.count = 0
+		self.modules = []
+		self.module_ids = {}
+		# last offset recorded in each module, by module_id
+		self.last_offsets = []
+		self.current_module = -1
+
+	def module_id(self, name, base=0, end=0, path=''):
+		module_id = self.module_ids.get(name)
+		if module_id == None:
+			if len(self.modules) >= COVERAGE_MAX_MODULES:
+				raise ValueError('too many modules in coverage trace')
+			module_id = len(self.modules)
+			self.module_ids[name] = module_id
+			self.modules.append((name, base, end, path))
+			self.last_offsets.append(0)
+		return module_id
+
+	def add(self, module_id, offset):
+		''' raises ValueError for offsets that don't fit in a u32 instead of truncating them '''
+		if offset < 0 or offset > COVERAGE_MAX_OFFSET:
+			raise ValueError('coverage offset 0x{0:x} out of range'.format(offset))
+
+		delta = offset - self.last_offsets[module_id]
+		self.last_offsets[module_id] = offset
+		# zigzag so short backward jumps stay small, low bit flags a module switch
+		value = (delta << 1) ^ (delta >> 63)
+		value = value << 1 | (module_id != self.current_module)
+
+		buffer = self.buffer
+		while value > 0x7F:
+			buffer.append(value & 0x7F | 0x80)
+			value >>= 7
+		buffer.append(value)
+		if module_id != self.current_module:
+			buffer += pack('<H', module_id)
+			self.current_module = module_id
+
+		self.count += 1
+		if len(buffer) >= COVERAGE_FLUSH_SIZE:
+			self.flush()
+
+	def flush(self):
+		self.file.write(self.buffer)
+		self.buffer = bytearray()
+
+	def close(self):
+		self.flush()
+		table_offset = self.file.tell()
+		self.file.write(pack('<I', len(self.modules)))
+		for name, base, end, path in self.modules:
+			name = name.encode('utf-8')
+			path = path.encode('utf-8')
+			self.file.write(pack('<QQHH', base, end, len(name), len(path)) + name + path)
+
+		self.file.seek(0)
+		self.file.write(pack(COVERAGE_HEADER, COVERAGE_MAGIC, table_offset, self.count))
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+def read_coverage(path):
+	'''
+		Layout: header (magic, module table offset, record count), records, then
+		the module table: u32 count and per module u64 base, u64 end, u16 name/path
+		lengths, name, path.
+		A record is a little endian base 128 varint v, bit 0 of v set means a u16
+		module_id follows. v >> 1 is the zigzag encoded difference with the previous
+		offset recorded in that module, starting from 0.
+		Returns (modules as (name, base, end, path), flat array of the
+		(module_id, offset) pairs) or None.
+	'''
+	with open(path, 'rb') as f:
+		data = f.read()
+
+	header_size = calcsize(COVERAGE_HEADER)
+	if len(data) < header_size:
+		return None
+	magic, table_offset, count = unpack_from(COVERAGE_HEADER, data)
+	if magic != COVERAGE_MAGIC or table_offset < header_size or table_offset > len(data):
+		return None
+
+	modules = []
+	pos = table_offset
+	module_count, = unpack_from('<I', data, pos)
+	pos += 4
+	for i in range(module_count):
+		base, end, name_len, path_len = unpack_from('<QQHH', data, pos)
+		pos += calcsize('<QQHH')
+		name = data[pos:pos + name_len].decode('utf-8')
+		pos += name_len
+		module_path = data[pos:pos + path_len].decode('utf-8')
+		pos += path_len
+		modules.append((name, base, end, module_path))
+
+	records = array('I')
+	last_offsets = [0] * module_count
+	module_id = 0
+	pos = header_size
+	for i in range(count):
+		value = shift = 0
+		while True:
+			byte = data[pos]
 			pos += 1
-		if saved == subseq: # if subseq equal saved then return pos of subseq
-			return pos
-	return -1
+			value |= (byte & 0x7F) << shift
+			shift += 7
+			if byte < 0x80:
+				break
+		if value & 1:
+			module_id, = unpack_from('<H', data, pos)
+			pos += 2
+		value >>= 1
+		offset = last_offsets[module_id] + ((value >> 1) ^ -(value & 1))
+		last_offsets[module_id] = offset
+		records.append(module_id)
+		records.append(offset)
+
+	return modules, records
+
+def coverage_to_text(src, dst):
+	''' module+offset lines, one per traced instruction, like the old cov output '''
+	coverage = read_coverage(src)
+	if not coverage:
+		return False
+	modules, records = coverage
+
+	names = [module[0] for module in modules]
+	with open(dst, 'w') as out:
+		out.writelines('{0}+0x{1:x}\n'.format(names[records[i]], records[i + 1]) for i in range(0, len(records), 2))
+	return True
+
+def coverage_to_drcov(src, dst):
+	''' drcov log of the unique traced addresses, each as a one byte block '''
+	coverage = read_coverage(src)
+	if not coverage:
+		return False
+	modules, records = coverage
+
+	seen = set()
+	blocks = []
+	for i in range(0, len(records), 2):
+		record = (records[i], records[i + 1])
+		if record not in seen:
+			seen.add(record)
+			blocks.append((record[0], record[1], 1))
+
+	write_drcov(dst, [(base, end, module_path or name) for name, base, end, module_path in modules], blocks)
+	return True
 
-def hexdump(addr, chars, sep, width, lines=0xFFFFFFF):
-	l = []
-	line_count = 0
-	while chars:
-		if line_count >= lines:
-			break
-		line = chars[:width]
-		chars = chars[width:]
-		line = line.ljust(width, b'\x00' )
-		if get_pointer_size() == 4:
-			szaddr = "0x%.08X" % addr
+# ----------------------------------------------------------
+# Call tracing
+# ----------------------------------------------------------
+
+def get_call_trace_symbols(target, module, pattern=None):
+	''' {load address: symbol} of the module functions cz/czr trace '''
+	symbols = {}
+	for symbol in module:
+		if symbol.GetType() != lldb.eSymbolTypeCode:
+			continue
+		sym_name = symbol.GetName()
+		if not sym_name:
+			continue
+		if pattern and not pattern.match(sym_name):
+			continue
+		# too hot or reentrant to be worth a stop
+		if sym_name.startswith("os") or "pthread" in sym_name or "lock" in sym_name or "operator" in sym_name:
+			continue
+
+		address = symbol.GetStartAddress().GetLoadAddress(target)
+		if address != lldb.LLDB_INVALID_ADDRESS:
+			symbols[address] = symbol
+
+	return symbols
+
+def dot_escape(name):
+	return name.replace('\\', '\\\\').replace('"', '\\"')
+
+class CallTracer(object):
+	'''
+		Breaks on a set of functions and records who calls them. Breakpoints are
+		created in one batch, hits and caller -> callee edges are kept in dicts
+		and each edge is streamed to log_path as it is seen. A function stays
+		armed until it was hit budget times, 0 means no limit.
+	'''
+	def __init__(self, target, module, symbols, log_path=None, budget=1):
+		self.target = target
+		self.module = module
+		self.symbols = symbols
+		self.budget = budget
+		self.breakpoints = []
+		# stop address -> (traced function address, breakpoint location)
+		self.locations = {}
+		self.hits = {}
+		self.edges = {}
+		# caller function address -> module!symbol, callees are named from symbols
+		self.caller_names = {}
+		self.log = open(log_path, 'w') if log_path else None
+
+	def arm(self):
+		# a single breakpoint with one location per function, restricted to the module
+		names = [symbol.GetMangledName() or symbol.GetName() for symbol in self.symbols.values()]
+		modules = lldb.SBFileSpecList()
+		modules.Append(self.module.GetFileSpec())
+		bp = self.target.BreakpointCreateByNames(names, lldb.eFunctionNameTypeFull, modules, lldb.SBFileSpecList())
+		self.breakpoints.append(bp)
+
+		armed = set()
+		for i in range(bp.GetNumLocations()):
+			location = bp.GetLocationAtIndex(i)
+			address = location.GetLoadAddress()
+			# by name locations may sit after the prologue, map them to their function
+			function = address
+			if function not in self.symbols:
+				function = location.GetAddress().GetSymbol().GetStartAddress().GetLoadAddress(self.target)
+
+			if function in self.symbols and function not in armed:
+				armed.add(function)
+				self.locations[address] = (function, location)
+			else:
+				# same name in a function we don't trace
+				location.SetEnabled(False)
+
+		# names lldb couldn't resolve fall back to a breakpoint per address
+		for address in self.symbols:
+			if address in armed:
+				continue
+			bp = self.target.BreakpointCreateByAddress(address)
+			self.breakpoints.append(bp)
+			if bp.GetNumLocations():
+				armed.add(address)
+				self.locations[address] = (address, bp.GetLocationAtIndex(0))
+
+		return len(armed)
+
+	def disarm(self):
+		for bp in self.breakpoints:
+			self.target.BreakpointDelete(bp.GetID())
+		self.breakpoints = []
+		self.locations = {}
+		if self.log:
+			self.log.close()
+			self.log = None
+
+	def record(self, thread, stop_address):
+		''' count the hit and its caller edge, returns the caller frame '''
+		address, location = self.locations[stop_address]
+		hits = self.hits.get(address, 0) + 1
+		self.hits[address] = hits
+		if self.budget and hits >= self.budget:
+			location.SetEnabled(False)
+
+		caller = thread.GetFrameAtIndex(1)
+		caller_symbol = caller.GetSymbol()
+		if caller_symbol.IsValid():
+			caller_addr = caller_symbol.GetStartAddress().GetLoadAddress(self.target)
 		else:
-			szaddr = "0x%.016lX" % addr
-		l.append("\033[1m%s :\033[0m %s%s \033[1m%s\033[0m" % (szaddr, sep.join( "%02X" % c for c in line ), sep, quotechars( line )))
-		addr += 0x10
-		line_count = line_count + 1
-	return "\n".join(l)
+			caller_addr = caller.GetPC()
+		edge = (caller_addr, address)
+		if edge not in self.edges:
+			self.edges[edge] = 0
+			if caller_addr not in self.caller_names:
+				self.caller_names[caller_addr] = '{0}!{1}'.format(
+					caller.GetModule().GetFileSpec().GetFilename(), caller_symbol.GetName() or hex(caller_addr))
+		self.edges[edge] += 1
+
+		if self.log:
+			callee = self.symbols[address]
+			self.log.write('0x{0:x}\t{1}!{2}\t0x{3:x}\t{4}!{5}\n'.format(
+				caller.GetPC(), caller.GetModule().GetFileSpec().GetFilename(), caller.GetSymbol().GetName(),
+				address, self.module.GetFileSpec().GetFilename(), callee.GetName()))
+
+		return caller
+
+	def function_name(self, address):
+		if address in self.symbols:
+			return '{0}!{1}'.format(self.module.GetFileSpec().GetFilename(), self.symbols[address].GetName())
+		return self.caller_names.get(address, hex(address))
+
+	def hot_functions(self):
+		''' [(hits, address, name)] sorted by hits, hottest first '''
+		functions = [(hits, address, self.function_name(address)) for address, hits in self.hits.items()]
+		functions.sort(key=lambda f: (-f[0], f[1]))
+		return functions
+
+	def write_call_graph(self, path):
+		''' caller -> callee graph weighted by calls, JSON for a .json path, DOT otherwise '''
+		if path.endswith('.json'):
+			graph = {
+				'functions': [{'address': address, 'name': name, 'hits': hits}
+								for hits, address, name in self.hot_functions()],
+				'edges': [{'caller': self.function_name(caller), 'callee': self.function_name(callee), 'calls': calls}
+							for (caller, callee), calls in self.edges.items()]
+			}
+			with open(path, 'w') as f:
+				json.dump(graph, f, indent=1)
+			return
+
+		with open(path, 'w') as f:
+			f.write('digraph callz {\n')
+			for hits, address, name in self.hot_functions():
+				f.write('\t"{0}" [label="{0}\\n{1} hits"];\n'.format(dot_escape(name), hits))
+			for (caller, callee), calls in self.edges.items():
+				f.write('\t"{0}" -> "{1}" [label="{2}"];\n'.format(
+					dot_escape(self.function_name(caller)), dot_escape(self.function_name(callee)), calls))
+			f.write('}\n')
+
+	def next_hits(self, process):
+		'''
+			continue until traced functions are hit, [(thread, stop address)] with
+			every thread stopped at one of them, or None when done
+		'''
+		process.Continue()
+		if process.GetState() != lldb.eStateStopped:
+			return None
+
+		hits = []
+		for thread in process:
+			if thread.GetStopReason() != lldb.eStopReasonBreakpoint:
+				continue
+			address = thread.GetFrameAtIndex(0).GetPC()
+			if address in self.locations:
+				hits.append((thread, address))
+
+		if not hits:
+			return None
+		process.SetSelectedThread(hits[0][0])
+		return hits
+
+# ----------------------------------------------------------
+# Hexdump
+# ----------------------------------------------------------
+
+# printable ascii stays, everything else shows as a dot
+HEXDUMP_ASCII = bytes(c if 0x20 <= c <= 126 else 0x2e for c in range(256))
+# memoryview.cast format of each dump unit size
+HEXDUMP_UNITS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+def hexdump_lines(addr, data, unit=1, width=16, pointer_size=8, mask=None, sep=' ', middle=None, ascii=True, hex_end='', colored=True):
+	'''
+	Render data as dump rows of width bytes holding values of unit bytes.
+	The buffer is hex encoded, cast and translated once, rows are slices of
+	that. Bytes outside a read_mem_masked mask show as ??, sep is a single
+	character and middle replaces it halfway through a row. colored=False
+	leaves out the terminal escapes, for text files.
+	'''
+	if len(data) % width:
+		data = bytes(data) + bytes(width - len(data) % width)
+	view = memoryview(data)
+	if view.format != 'B':
+		view = view.cast('B')
+	if mask != None and len(mask) < len(view):
+		mask = bytes(mask) + bytes(len(view) - len(mask))
+
+	addr_fmt = "0x%.08X" if pointer_size == 4 else "0x%.016lX"
+	bold, reset = ("\033[1m", "\033[0m") if colored else ("", "")
+	line_fmt = bold + "%s :" + reset + " %s" + hex_end
+	if ascii:
+		line_fmt += " " + bold + "%s" + reset
+		text = view.tobytes().translate(HEXDUMP_ASCII).decode('ascii')
+
+	per_row = width // unit
+	half = per_row // 2
+	unit_fmt = '%%.0%dX' % (unit * 2)
+	if middle == None:
+		value_fmt = sep.join([unit_fmt] * per_row)
+	else:
+		value_fmt = sep.join([unit_fmt] * half) + middle + sep.join([unit_fmt] * (per_row - half))
+
+	if unit == 1:
+		hex_text = view.hex(sep).upper()
+		stride = 2 + len(sep)
+	else:
+		values = view.cast(HEXDUMP_UNITS[unit])
+	full_unit = b'\x01' * unit
+	full_row = b'\x01' * width
+
+	lines = []
+	for offset in range(0, len(view), width):
+		row_mask = mask[offset:offset + width] if mask != None else full_row
+		if row_mask == full_row:
+			if unit == 1:
+				row = hex_text[offset * stride:(offset + width) * stride - len(sep)]
+				if middle != None:
+					row = row[:half * stride - len(sep)] + middle + row[half * stride:]
+			else:
+				first = offset // unit
+				row = value_fmt % tuple(values[first:first + per_row].tolist())
+			if ascii:
+				lines.append(line_fmt % (addr_fmt % (addr + offset), row, text[offset:offset + width]))
+			else:
+				lines.append(line_fmt % (addr_fmt % (addr + offset), row))
+			continue
+
+		# rows touching unreadable memory are rendered unit by unit
+		units = []
+		for i in range(offset, offset + width, unit):
+			if row_mask[i - offset:i - offset + unit] != full_unit:
+				units.append('??' * unit)
+			elif unit == 1:
+				units.append(unit_fmt % view[i])
+			else:
+				units.append(unit_fmt % values[i // unit])
+		if middle == None:
+			row = sep.join(units)
+		else:
+			row = sep.join(units[:half]) + middle + sep.join(units[half:])
+		if ascii:
+			chars = ''.join(text[offset + i] if row_mask[i] else ' ' for i in range(width))
+			lines.append(line_fmt % (addr_fmt % (addr + offset), row, chars))
+		else:
+			lines.append(line_fmt % (addr_fmt % (addr + offset), row))
+
+	return lines
+
+def hexdump(addr, chars, sep, width, lines=0xFFFFFFF, pointer_size=0):
+	if not pointer_size:
+		pointer_size = get_pointer_size()
+	chars = memoryview(chars)[:lines * width]
+	return "\n".join(hexdump_lines(addr, chars, 1, width, pointer_size, sep=sep, hex_end=sep))
 
 def quotechars( chars ):
-	data = ""
-	for x in bytearray(chars):
-		if x >= 0x20 and x <= 126:
-			data += chr(x)
-		else:       
-			data += "."
-	return data
+	return bytes(chars).translate(HEXDUMP_ASCII).decode('ascii')
 
 def GetUUIDSummary(uuid_bytes : bytes):
 
@@ -916,17 +2155,42 @@ def dyld_arm64_resolve_dispatch(target, target_address):
 		out goal to resolve symbol for this address
 	'''
 
-	instructions = target.ReadInstructions(lldb.SBAddress(target_address, target), 3, 'intel')
-	if instructions.GetSize() == 0:
+	instructions = get_instructions(target_address, 3)
+	if len(instructions) < 3:
 		return 0
 	
-	if instructions[0].GetMnemonic(target) != 'adrp' or instructions[1].GetMnemonic(target) != 'add' or \
-		(instructions[2].GetMnemonic(target) != 'br' and instructions[2].GetOperands(target).startswith('x')):
+	if instructions[0].mnemonic != 'adrp' or instructions[1].mnemonic != 'add' or \
+		(instructions[2].mnemonic != 'br' and instructions[2].operands.startswith('x')):
 		return 0
 	
-	page_shift = int(instructions[0].GetOperands(target).split(',')[1])
+	page_shift = int(instructions[0].operands.split(',')[1])
 	target_page = (target_address + page_shift * 0x1000) & 0xFFFFFFFFFFFFF000
-	call_offset = int(instructions[1].GetOperands(target).split(',')[2].strip(' #'), 16)
+	call_offset = int(instructions[1].operands.split(',')[2].strip(' #'), 16)
 	call_func_ptr = target_page + call_offset 
 
-	return call_func_ptr
\ No newline at end of file
+	return call_func_ptr
+
+# stub address -> (dispatch address, symbol name) of the selected target
+dyld_stub_cache = {}
+# (target, process unique id, code generation) the cached stubs were decoded in,
+# a relaunch slides the images and a memory write may patch a stub
+dyld_stub_cache_key = None
+
+def resolve_dyld_stub(target, stub_address):
+	global dyld_stub_cache, dyld_stub_cache_key
+
+	key = (target, target.GetProcess().GetUniqueID(), code_generation)
+	if dyld_stub_cache_key != key:
+		dyld_stub_cache = {}
+		dyld_stub_cache_key = key
+
+	if stub_address not in dyld_stub_cache:
+		call_addr = dyld_arm64_resolve_dispatch(target, stub_address)
+		name = resolve_symbol_name(call_addr) if call_addr else ''
+		dyld_stub_cache[stub_address] = (call_addr, name)
+
+	return dyld_stub_cache[stub_address]
+
+def invalidate_dyld_stub_cache():
+	global dyld_stub_cache_key
+	dyld_stub_cache_key = None
\ No newline at end of file